@@ -0,0 +1,128 @@
+import copy
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import polling
+
+# Simulated latency (in seconds) added to the virtual clock for every call
+default_latency = {"sts": 0.15, "secretsmanager": 0.05, "ecs": 0.08, "ecr": 0.12, "ssm": 0.04}
+
+class VirtualClock(polling.Clock):
+  def __init__(self, wall_start: float = 0):
+    self.time = 0.0
+    self.wall_start = wall_start
+    self.lock = threading.Lock()
+
+  def now(self) -> float:
+    return self.time
+
+  def wall(self) -> float:
+    return self.wall_start + self.time
+
+  def sleep(self, seconds: float):
+    self.advance(seconds)
+
+  def advance(self, seconds: float):
+    with self.lock:
+      self.time += seconds
+
+class StandInError(Exception):
+  def __init__(self, code: str, message: str = ""):
+    super().__init__(code + ": " + message)
+    self.code = code
+    self.message = message
+
+class StandInHttpResponse:
+  def __init__(self, status_code: int):
+    self.status_code = status_code
+    self.headers = {}
+    self.content = b""
+    self.raw = None
+
+# Answers API calls made through the shared boto3 session without touching the
+# network. Handlers receive the call parameters and return the parsed response,
+# in the same way botocore's Stubber short circuits requests.
+class AwsStandIn:
+  def __init__(self, clock: VirtualClock, latency: dict = None):
+    self.clock = clock
+    self.latency = latency or default_latency
+    self.handlers = {}
+    self.calls = Counter()
+    self.lock = threading.Lock()
+
+  def register(self, aws_service: str, operation: str, handler):
+    self.handlers[(aws_service, operation)] = handler
+
+  def register_all(self, aws_service: str, fake):
+    for operation, handler in fake.operations().items():
+      self.register(aws_service, operation, handler)
+
+  def install(self, session):
+    session.events.register("before-parameter-build", self.capture_parameters)
+    session.events.register("before-call", self.respond)
+
+  def capture_parameters(self, params, context, **kwargs):
+    context["standin_params"] = copy.deepcopy(params)
+
+  def respond(self, model, context, **kwargs):
+    aws_service = model.service_model.service_name
+    with self.lock:
+      self.calls[aws_service + "." + model.name] += 1
+      self.clock.advance(self.latency.get(aws_service, 0.05))
+      handler = self.handlers.get((aws_service, model.name))
+      if (handler is None):
+        raise NotImplementedError("The AWS stand-in does not implement " + aws_service + "." + model.name)
+      try:
+        parsed = handler(context.get("standin_params", {}))
+        status_code = 200
+      except StandInError as error:
+        parsed = {"Error": {"Code": error.code, "Message": error.message}}
+        status_code = 400
+    parsed["ResponseMetadata"] = {"HTTPStatusCode": status_code, "RetryAttempts": 0}
+    return StandInHttpResponse(status_code), parsed
+
+class PushgatewayHandler(BaseHTTPRequestHandler):
+  def handle_push(self):
+    length = int(self.headers.get("Content-Length", 0))
+    self.server.requests.append({"method": self.command, "path": self.path, "bytes": len(self.rfile.read(length))})
+    self.send_response(200)
+    self.end_headers()
+
+  do_PUT = handle_push
+  do_POST = handle_push
+  do_DELETE = handle_push
+
+  def log_message(self, format, *args):
+    pass
+
+class FakePushgateway:
+  def __init__(self):
+    self.server = HTTPServer(("127.0.0.1", 0), PushgatewayHandler)
+    self.server.requests = []
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+  def start(self) -> str:
+    self.thread.start()
+    return "http://127.0.0.1:" + str(self.server.server_port)
+
+  def requests(self) -> list:
+    return self.server.requests
+
+  def stop(self):
+    self.server.shutdown()
+
+def paginate(items: list, params: dict, key: str, default_page_size: int = 100) -> dict:
+  start = int(params.get("nextToken", 0))
+  page_size = params.get("maxResults", default_page_size)
+  response = {key: items[start:(start + page_size)]}
+  if ((start + page_size) < len(items)):
+    response["nextToken"] = str(start + page_size)
+  return response
+
+def secret_string(accounts: dict) -> str:
+  config = {"push_gateway_username": "benchmark", "push_gateway_password": "benchmark"}
+  for account, number in accounts.items():
+    config[account + "_account"] = number
+  return json.dumps(config)
@@ -0,0 +1,153 @@
+import argparse
+import importlib
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+scripts_directory = os.path.join(os.path.dirname(benchmark_directory), "scripts", "python")
+sys.path.insert(0, scripts_directory)
+sys.path.insert(0, benchmark_directory)
+
+# Compared against the baseline, the remaining measurements are informational
+compared_measurements = ["total_api_calls", "simulated_seconds"]
+
+def run_scenario(name: str) -> dict:
+  from scenarios import scenarios, epoch, FakeSts, FakeSecretsManager
+  from aws_standin import AwsStandIn, VirtualClock, FakePushgateway
+  import polling
+  import deployment_utilities
+  import metrics_spool
+
+  random.seed(0)
+  clock = VirtualClock(wall_start=epoch.timestamp())
+  polling.set_clock(clock)
+  standin = AwsStandIn(clock)
+  standin.install(deployment_utilities.get_session())
+  standin.register_all("sts", FakeSts(clock))
+  standin.register_all("secretsmanager", FakeSecretsManager())
+  pushgateway = FakePushgateway()
+  metrics_spool.push_gateway_url = pushgateway.start()
+
+  module_name, arguments, workdir = scenarios[name](standin, clock, os.getcwd())
+  module = importlib.import_module(module_name)
+  os.chdir(workdir)
+  sys.argv = [module_name + ".py"] + arguments
+  exit_code = 0
+  tracemalloc.start()
+  started = time.perf_counter()
+  try:
+    module.main()
+  except SystemExit as error:
+    exit_code = error.code if isinstance(error.code, int) else 1
+  wall_seconds = time.perf_counter() - started
+  peak_memory = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  pushgateway.stop()
+
+  return {
+    "scenario": name,
+    "exit_code": exit_code,
+    "api_calls": dict(sorted(standin.calls.items())),
+    "total_api_calls": sum(standin.calls.values()),
+    "simulated_seconds": round(clock.now(), 2),
+    "wall_seconds": round(wall_seconds, 3),
+    "peak_memory_bytes": peak_memory,
+    "pushgateway_requests": len(pushgateway.requests()),
+  }
+
+# Each scenario runs in its own process so that caches, module state and peak
+# memory do not leak between them.
+def run_isolated(name: str, verbose: bool) -> dict:
+  with tempfile.TemporaryDirectory() as workdir:
+    environment = dict(os.environ)
+    environment.update({
+      "AWS_ACCESS_KEY_ID": "benchmark",
+      "AWS_SECRET_ACCESS_KEY": "benchmark",
+      "AWS_DEFAULT_REGION": "eu-west-1",
+      "DEPLOYMENT_CACHE_DIR": os.path.join(workdir, "cache"),
+      "DEPLOYMENT_PERSISTENT_CACHE_DIR": os.path.join(workdir, "persistent-cache"),
+    })
+    for variable in ["AWS_SESSION_TOKEN", "AWS_PROFILE", "DEPLOYMENT_METRICS_SPOOL", "DEPLOYMENT_TRACE_FILE"]:
+      environment.pop(variable, None)
+    result_path = os.path.join(workdir, "result.json")
+    process = subprocess.run(
+      [sys.executable, os.path.abspath(__file__), "--child", name, "--output", result_path],
+      cwd=workdir,
+      env=environment,
+      stdout=(None if verbose else subprocess.DEVNULL),
+      stderr=(None if verbose else subprocess.DEVNULL),
+    )
+    if (not os.path.isfile(result_path)):
+      return {"scenario": name, "error": "Scenario crashed with exit status (" + str(process.returncode) + ")"}
+    with open(result_path, "r") as file:
+      return json.load(file)
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+  regressions = []
+  for result in results:
+    expected = baseline.get(result["scenario"])
+    if ("error" in result):
+      regressions.append(result["scenario"] + ": " + result["error"])
+      continue
+    if (expected is None):
+      continue
+    if (result["exit_code"] != expected["exit_code"]):
+      regressions.append(result["scenario"] + ": exit status changed from (" + str(expected["exit_code"]) + ") to (" + str(result["exit_code"]) + ")")
+    for measurement in compared_measurements:
+      if (result[measurement] > (expected[measurement] * (1 + tolerance))):
+        regressions.append(result["scenario"] + ": " + measurement + " increased from (" + str(expected[measurement]) + ") to (" + str(result[measurement]) + ")")
+  return regressions
+
+def print_results(results: list):
+  print("%-28s %5s %9s %11s %9s %12s %6s" % ("scenario", "exit", "api_calls", "simulated_s", "wall_s", "peak_memory", "pushes"))
+  for result in results:
+    if ("error" in result):
+      print("%-28s %s" % (result["scenario"], result["error"]))
+      continue
+    print("%-28s %5d %9d %11.1f %9.3f %12d %6d" % (result["scenario"], result["exit_code"], result["total_api_calls"], result["simulated_seconds"], result["wall_seconds"], result["peak_memory_bytes"], result["pushgateway_requests"]))
+
+def main():
+  parser = argparse.ArgumentParser(description="Deployment Scripts Benchmark Script")
+
+  parser.add_argument("--scenario", type=str, nargs='+', help="The scenarios to run, defaults to all of them")
+  parser.add_argument("--output", type=str, help="The file the results are written to as JSON")
+  parser.add_argument("--baseline", type=str, help="A previous results file to check for regressions against")
+  parser.add_argument("--tolerance", default=0.1, type=float, help="The fraction a measurement may grow by before it counts as a regression")
+  parser.add_argument("--verbose", action="store_true", help="Shows the output of the scripts being benchmarked")
+  parser.add_argument("--child", type=str, help=argparse.SUPPRESS)
+
+  args = parser.parse_args()
+
+  if (args.child):
+    logging.disable(logging.CRITICAL if not args.verbose else logging.NOTSET)
+    result = run_scenario(args.child)
+    with open(args.output, "w") as file:
+      json.dump(result, file)
+    return
+
+  from scenarios import scenarios
+  names = args.scenario or list(scenarios)
+  results = [run_isolated(name, verbose=args.verbose) for name in names]
+  print_results(results)
+
+  if (args.output):
+    with open(args.output, "w") as file:
+      json.dump({result["scenario"]: result for result in results}, file, indent=2)
+
+  if (args.baseline):
+    with open(args.baseline, "r") as file:
+      regressions = compare(results, json.load(file), args.tolerance)
+    for regression in regressions:
+      print("Regression: " + regression)
+    if (len(regressions) > 0):
+      exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,352 @@
+import datetime
+import json
+import os
+
+from aws_standin import StandInError, paginate, secret_string
+
+epoch = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+accounts = {"development": "111111111111", "uat": "222222222222", "production": "333333333333", "management": "444444444444"}
+
+class FakeSts:
+  def __init__(self, clock):
+    self.clock = clock
+
+  def operations(self) -> dict:
+    return {"AssumeRole": self.assume_role}
+
+  def assume_role(self, params: dict) -> dict:
+    expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    return {"Credentials": {"AccessKeyId": "ASIABENCHMARK", "SecretAccessKey": "benchmark", "SessionToken": "benchmark", "Expiration": expiration}}
+
+class FakeSecretsManager:
+  def operations(self) -> dict:
+    return {"GetSecretValue": self.get_secret_value}
+
+  def get_secret_value(self, params: dict) -> dict:
+    return {"SecretString": secret_string(accounts)}
+
+# A deployment whose counts follow a fixed timeline (in virtual seconds from
+# the moment it was created).
+class FakeDeployment:
+  def __init__(self, deployment_id: str, task_definition: str, created_at: float, pending_after: float = 10, running_after: float = 60, fail_after: float = None, desired_count: int = 1, completed: bool = False, crash_every: float = None, drain_seconds: float = 0):
+    self.id = deployment_id
+    self.task_definition = task_definition
+    self.created_at = created_at
+    self.pending_after = pending_after
+    self.running_after = running_after
+    self.fail_after = fail_after
+    self.desired_count = desired_count
+    self.completed = completed
+    self.crash_every = crash_every
+    self.drain_seconds = drain_seconds
+    self.draining_since = None
+    self.running_before_drain = 0
+
+  def scale(self, desired_count: int, now: float):
+    if ((desired_count == 0) and (self.desired_count > 0)):
+      self.draining_since = now
+      self.running_before_drain = self.desired_count
+    self.desired_count = desired_count
+
+  # A crash looping deployment never reaches running, it only leaves stopped
+  # tasks behind and ECS does not count them as failed tasks.
+  def stopped_tasks(self, now: float) -> list:
+    if (self.crash_every is None):
+      return []
+    crashes = int(max(0, now - self.created_at - self.pending_after) // self.crash_every)
+    return [{
+      "taskArn": "arn:aws:ecs:eu-west-1:111111111111:task/core-services/" + self.id.split("/")[-1] + "-" + str(index),
+      "startedBy": self.id,
+      "lastStatus": "STOPPED",
+      "stopCode": "EssentialContainerExited",
+      "stoppedReason": "Essential container in task exited",
+      "containers": [{"name": "app", "exitCode": 1}],
+    } for index in range(crashes)]
+
+  def describe(self, now: float) -> dict:
+    elapsed = now - self.created_at
+    deployment = {
+      "id": self.id,
+      "status": "PRIMARY",
+      "taskDefinition": self.task_definition,
+      "desiredCount": self.desired_count,
+      "pendingCount": 0,
+      "runningCount": 0,
+      "failedTasks": 0,
+      "createdAt": epoch + datetime.timedelta(seconds=self.created_at),
+      "rolloutState": "IN_PROGRESS",
+    }
+    if ((self.fail_after is not None) and (elapsed >= self.fail_after)):
+      deployment["failedTasks"] = 1
+    elif ((self.draining_since is not None) and ((now - self.draining_since) < self.drain_seconds)):
+      deployment["runningCount"] = self.running_before_drain
+      deployment["rolloutState"] = "COMPLETED"
+    elif (self.crash_every is not None):
+      deployment["pendingCount"] = self.desired_count if (elapsed >= self.pending_after) else 0
+    elif (self.completed or (elapsed >= self.running_after)):
+      deployment["runningCount"] = self.desired_count
+      deployment["rolloutState"] = "COMPLETED"
+    elif (elapsed >= self.pending_after):
+      deployment["pendingCount"] = self.desired_count
+    return deployment
+
+class FakeService:
+  def __init__(self, name: str, deployments: list, revert_deployment: dict = None):
+    self.name = name
+    self.deployments = deployments
+    self.revert_deployment = revert_deployment or {}
+    self.counter = len(deployments)
+
+  def describe(self, now: float) -> dict:
+    deployments = [deployment.describe(now) for deployment in self.deployments]
+    if ((len(deployments) > 1) and (deployments[-1]["rolloutState"] == "COMPLETED")):
+      deployments = deployments[-1:]
+      self.deployments = self.deployments[-1:]
+    for deployment in deployments[:-1]:
+      deployment["status"] = "ACTIVE"
+    deployments.reverse()
+    return {
+      "serviceName": self.name,
+      "status": "ACTIVE",
+      "runningCount": sum(deployment["runningCount"] for deployment in deployments),
+      "pendingCount": sum(deployment["pendingCount"] for deployment in deployments),
+      "deployments": deployments,
+      "events": [],
+    }
+
+class FakeEcs:
+  def __init__(self, clock, services: list):
+    self.clock = clock
+    self.services = {service.name: service for service in services}
+
+  def operations(self) -> dict:
+    return {"DescribeServices": self.describe_services, "UpdateService": self.update_service, "ListTasks": self.list_tasks, "DescribeTasks": self.describe_tasks}
+
+  def describe_services(self, params: dict) -> dict:
+    described = [self.services[name].describe(self.clock.now()) for name in params["services"] if name in self.services]
+    failures = [{"arn": name, "reason": "MISSING"} for name in params["services"] if name not in self.services]
+    return {"services": described, "failures": failures}
+
+  def update_service(self, params: dict) -> dict:
+    service = self.services[params["service"]]
+    if ("taskDefinition" in params):
+      service.counter += 1
+      service.deployments.append(FakeDeployment(("ecs-svc/" + str(service.counter)), params["taskDefinition"], self.clock.now(), **service.revert_deployment))
+    if ("desiredCount" in params):
+      service.deployments[-1].scale(params["desiredCount"], self.clock.now())
+    return {"service": service.describe(self.clock.now())}
+
+  def stopped_tasks(self, service_name: str = None) -> list:
+    return [task for service in self.services.values() if service_name in [None, service.name] for deployment in service.deployments for task in deployment.stopped_tasks(self.clock.now())]
+
+  # ListTasks only accepts startedBy as its one and only filter
+  def list_tasks(self, params: dict) -> dict:
+    filters = [name for name in params if name not in ["cluster", "nextToken", "maxResults"]]
+    if (("startedBy" in filters) and (len(filters) > 1)):
+      raise StandInError("InvalidParameterException", "startedBy cannot be combined with other filters")
+    if (params.get("desiredStatus", "RUNNING") != "STOPPED"):
+      return {"taskArns": []}
+    task_arns = [task["taskArn"] for task in self.stopped_tasks(params.get("serviceName")) if params.get("startedBy", task["startedBy"]) == task["startedBy"]]
+    return paginate(task_arns, params, "taskArns")
+
+  def describe_tasks(self, params: dict) -> dict:
+    if (len(params["tasks"]) > 100):
+      raise StandInError("InvalidParameterException", "tasks can contain at most 100 entries")
+    return {"tasks": [task for task in self.stopped_tasks() if task["taskArn"] in params["tasks"]], "failures": []}
+
+class FakeEcr:
+  def __init__(self, clock, repositories: dict, scan_duration: float = 60):
+    self.clock = clock
+    self.repositories = repositories
+    self.scan_duration = scan_duration
+    self.scans = {}
+
+  def operations(self) -> dict:
+    return {
+      "DescribeRepositories": self.describe_repositories,
+      "DescribeImages": self.describe_images,
+      "ListImages": self.list_images,
+      "StartImageScan": self.start_image_scan,
+      "BatchDeleteImage": self.batch_delete_image,
+      "GetAuthorizationToken": self.get_authorization_token,
+    }
+
+  def describe_repositories(self, params: dict) -> dict:
+    return paginate([{"repositoryName": name} for name in self.repositories], params, "repositories")
+
+  def image_detail(self, repository: str, image: dict) -> dict:
+    detail = dict(image)
+    scan_started = self.scans.get((repository, image["imageDigest"]))
+    if (scan_started is not None):
+      if ((self.clock.now() - scan_started) >= self.scan_duration):
+        detail["imageScanStatus"] = {"status": "COMPLETE"}
+        detail["imageScanFindingsSummary"] = {"findingSeverityCounts": {"MEDIUM": 3, "LOW": 7}}
+      else:
+        detail["imageScanStatus"] = {"status": "IN_PROGRESS"}
+    return detail
+
+  def describe_images(self, params: dict) -> dict:
+    images = self.repositories[params["repositoryName"]]
+    if ("imageIds" in params):
+      digests = [image_id["imageDigest"] for image_id in params["imageIds"]]
+      return {"imageDetails": [self.image_detail(params["repositoryName"], image) for image in images if image["imageDigest"] in digests]}
+    response = paginate(images, params, "imageDetails")
+    response["imageDetails"] = [self.image_detail(params["repositoryName"], image) for image in response["imageDetails"]]
+    return response
+
+  def list_images(self, params: dict) -> dict:
+    image_ids = [{"imageDigest": image["imageDigest"], "imageTag": tag} for image in self.repositories[params["repositoryName"]] for tag in image.get("imageTags", [])]
+    return paginate(image_ids, params, "imageIds")
+
+  def start_image_scan(self, params: dict) -> dict:
+    key = (params["repositoryName"], params["imageId"]["imageDigest"])
+    if ((key in self.scans) and ((self.clock.now() - self.scans[key]) >= self.scan_duration)):
+      raise StandInError("LimitExceededException", "The image has already been scanned today")
+    self.scans[key] = self.clock.now()
+    return {"repositoryName": params["repositoryName"], "imageId": params["imageId"], "imageScanStatus": {"status": "IN_PROGRESS"}}
+
+  def batch_delete_image(self, params: dict) -> dict:
+    if (len(params["imageIds"]) > 100):
+      raise StandInError("InvalidParameterException", "imageIds can contain at most 100 entries")
+    digests = [image_id["imageDigest"] for image_id in params["imageIds"]]
+    self.repositories[params["repositoryName"]] = [image for image in self.repositories[params["repositoryName"]] if image["imageDigest"] not in digests]
+    return {"imageIds": params["imageIds"], "failures": []}
+
+  def get_authorization_token(self, params: dict) -> dict:
+    expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=12)
+    return {"authorizationData": [{"authorizationToken": "QVdTOmJlbmNobWFyaw==", "expiresAt": expires_at, "proxyEndpoint": "https://" + accounts["development"] + ".dkr.ecr.eu-west-1.amazonaws.com"}]}
+
+class FakeSsm:
+  def __init__(self, parameters: dict, concurrent_writes: dict = None):
+    self.history = {name: [value] for name, value in parameters.items()}
+    self.concurrent_writes = concurrent_writes or {}
+
+  def operations(self) -> dict:
+    return {"GetParameter": self.get_parameter, "GetParameters": self.get_parameters, "GetParametersByPath": self.get_parameters_by_path, "PutParameter": self.put_parameter}
+
+  def parameter(self, selector: str) -> dict:
+    name, _, version = selector.partition(":")
+    if (name not in self.history):
+      return None
+    number = int(version) if version else len(self.history[name])
+    if ((number < 1) or (number > len(self.history[name]))):
+      return None
+    return {"Name": name, "Value": self.history[name][number - 1], "Version": number}
+
+  def get_parameter(self, params: dict) -> dict:
+    parameter = self.parameter(params["Name"])
+    if (parameter is None):
+      raise StandInError("ParameterNotFound", params["Name"])
+    return {"Parameter": parameter}
+
+  def get_parameters(self, params: dict) -> dict:
+    if (len(params["Names"]) > 10):
+      raise StandInError("ValidationException", "Names can contain at most 10 entries")
+    found = [self.parameter(name) for name in params["Names"]]
+    return {"Parameters": [parameter for parameter in found if parameter is not None], "InvalidParameters": [name for name, parameter in zip(params["Names"], found) if parameter is None]}
+
+  def get_parameters_by_path(self, params: dict) -> dict:
+    found = [self.parameter(name) for name in sorted(self.history) if name.startswith(params["Path"])]
+    response = paginate(found, {"nextToken": params.get("NextToken", 0), "maxResults": params.get("MaxResults", 10)}, "Parameters")
+    if ("nextToken" in response):
+      response["NextToken"] = response.pop("nextToken")
+    return response
+
+  # A concurrent write lands just before the next put of the same parameter
+  def put_parameter(self, params: dict) -> dict:
+    if (params["Name"] in self.concurrent_writes):
+      self.history.setdefault(params["Name"], []).append(self.concurrent_writes.pop(params["Name"]))
+    self.history.setdefault(params["Name"], []).append(params["Value"])
+    return {"Version": len(self.history[params["Name"]])}
+
+def images(count: int, repository: str) -> list:
+  return [{
+    "imageDigest": "sha256:" + repository + "-" + str(index),
+    "imageTags": ["v" + str(index)] if (index % 10) else [],
+    "imagePushedAt": epoch + datetime.timedelta(hours=index),
+    "imageSizeInBytes": 50 * 1024 * 1024,
+  } for index in range(count)]
+
+def service_with_rollout(name: str, **new_deployment) -> FakeService:
+  return FakeService(name, [
+    FakeDeployment("ecs-svc/1", name + ":1", created_at=-3600, completed=True),
+    FakeDeployment("ecs-svc/2", name + ":2", created_at=0, **new_deployment),
+  ], revert_deployment={"pending_after": 10, "running_after": 90})
+
+# Every scenario registers its fakes on the stand-in and returns the script to
+# run, its arguments and the directory to run it in.
+def track_slow_rollout(standin, clock, workdir):
+  standin.register_all("ecs", FakeEcs(clock, [service_with_rollout("web", pending_after=20, running_after=240)]))
+  return "track_deployment", ["--service", "web", "--environment", "development"], workdir
+
+def track_failed_task_revert(standin, clock, workdir):
+  standin.register_all("ecs", FakeEcs(clock, [service_with_rollout("web", pending_after=20, running_after=600, fail_after=60)]))
+  return "track_deployment", ["--service", "web", "--environment", "production"], workdir
+
+def track_many_services(standin, clock, workdir):
+  services = [service_with_rollout("web-" + str(index), pending_after=20, running_after=(120 + (index * 10))) for index in range(25)]
+  standin.register_all("ecs", FakeEcs(clock, services))
+  return "track_deployment", (["--environment", "development", "--service"] + [service.name for service in services]), workdir
+
+def track_crash_loop_revert(standin, clock, workdir):
+  standin.register_all("ecs", FakeEcs(clock, [service_with_rollout("web", pending_after=20, crash_every=45)]))
+  return "track_deployment", ["--service", "web", "--environment", "production"], workdir
+
+def stop_many_services(standin, clock, workdir):
+  services = [FakeService("web-" + str(index), [FakeDeployment("ecs-svc/1", "web:1", created_at=-3600, completed=True, desired_count=2, drain_seconds=(5 + (index * 3)))]) for index in range(20)]
+  standin.register_all("ecs", FakeEcs(clock, services))
+  return "stop_service", (["--environment", "development", "--service"] + [service.name for service in services]), workdir
+
+def image_scan_in_progress(standin, clock, workdir):
+  ecr = FakeEcr(clock, {"web": images(50, "web")}, scan_duration=75)
+  ecr.scans[("web", "sha256:web-49")] = clock.now()
+  standin.register_all("ecr", ecr)
+  return "image_scan", ["--service", "web", "--environment", "development"], workdir
+
+def purge_large_repository(standin, clock, workdir):
+  standin.register_all("ecr", FakeEcr(clock, {"web": images(5000, "web")}))
+  return "purge_image", ["--service", "web", "--environment", "development"], workdir
+
+def versioning_fetch(standin, clock, workdir):
+  standin.register_all("ssm", FakeSsm({"/ecs/versions/web": "1.4.2"}))
+  os.makedirs(os.path.join(workdir, "deploy"), exist_ok=True)
+  return "versioning", ["--service", "web", "--fetch"], os.path.join(workdir, "deploy")
+
+def versioning_save_many(standin, clock, workdir):
+  services = ["web-" + str(index) for index in range(30)]
+  standin.register_all("ssm", FakeSsm({"/ecs/versions/" + service: "1.4.2" for service in services}, concurrent_writes={"/ecs/versions/web-7": "1.6.0"}))
+  for service in services:
+    os.makedirs(os.path.join(workdir, "deploy", service), exist_ok=True)
+    with open(os.path.join(workdir, "deploy", service, "package.json"), "w") as file:
+      json.dump({"name": service, "version": "1.5.0"}, file)
+  return "versioning", (["--save", "--service"] + services), os.path.join(workdir, "deploy")
+
+def ecr_authenticate_environments(standin, clock, workdir):
+  standin.register_all("ecr", FakeEcr(clock, {}))
+  with open(os.path.join(workdir, "terraform.tfvars"), "w") as file:
+    file.write("service_name = \"web\"\ndocker_password = \"expired\"\n")
+  return "ecr_authenticate", ["--environment", "development", "uat", "production"], workdir
+
+def preflight_all_tasks(standin, clock, workdir):
+  standin.register_all("ssm", FakeSsm({"/ecs/versions/web": "1.4.2"}))
+  standin.register_all("ecr", FakeEcr(clock, {}))
+  os.makedirs(os.path.join(workdir, "deploy"), exist_ok=True)
+  return "preflight", ["--service", "web", "--environment", "production"], os.path.join(workdir, "deploy")
+
+def pipeline_report(standin, clock, workdir):
+  return "pipeline_reporting", ["--service", "web", "--environment", "development", "--success"], workdir
+
+scenarios = {
+  "track-slow-rollout": track_slow_rollout,
+  "track-failed-task-revert": track_failed_task_revert,
+  "track-many-services": track_many_services,
+  "track-crash-loop-revert": track_crash_loop_revert,
+  "stop-many-services": stop_many_services,
+  "image-scan-in-progress": image_scan_in_progress,
+  "purge-5000-images": purge_large_repository,
+  "versioning-fetch": versioning_fetch,
+  "versioning-save-many": versioning_save_many,
+  "ecr-authenticate": ecr_authenticate_environments,
+  "preflight": preflight_all_tasks,
+  "pipeline-report": pipeline_report,
+}
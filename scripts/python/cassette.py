@@ -0,0 +1,288 @@
+import argparse
+import base64
+import bisect
+import datetime
+import json
+import logging
+import os
+import runpy
+import sys
+import threading
+import time
+
+import instrumentation
+import polling
+
+# Records every AWS call made through the shared session (parameters, response
+# and a timestamp) to an append only JSON lines cassette, or replays one. In
+# replay mode responses are served by virtual time: each call gets the latest
+# response recorded at or before the same point of the original run, so polling
+# can be retuned against a real trace while sleeps are compressed or skipped.
+redacted = "REDACTED"
+sensitive_words = ["password", "secret", "token", "key"]
+
+# Operations that describe a list of resources by ID, as (request parameter,
+# response list, the IDs of a response item). A call whose exact parameters were
+# never recorded is answered item by item from the recorded responses that
+# included each ID, never with a response for a different set of IDs.
+id_list_operations = {
+  "ecs.DescribeTasks": ("tasks", "tasks", lambda item: [item["taskArn"]]),
+  "ecs.DescribeServices": ("services", "services", lambda item: [item[key] for key in ["serviceName", "serviceArn"] if (key in item)]),
+  "ecr.DescribeImages": ("imageIds", "imageDetails", lambda item: [item["imageDigest"]] + item.get("imageTags", [])),
+  "ssm.GetParameters": ("Names", "Parameters", lambda item: [item["Name"] + item.get("Selector", "")]),
+}
+
+def mode() -> str:
+  return os.environ.get("DEPLOYMENT_CASSETTE_MODE", "off").lower()
+
+def replaying() -> bool:
+  return (mode() == "replay")
+
+def cassette_path() -> str:
+  from ttl_cache import default_cache_directory
+  return os.environ.get("DEPLOYMENT_CASSETTE", os.path.join(default_cache_directory(), "deployment-cassette.jsonl"))
+
+def encode(value):
+  if isinstance(value, datetime.datetime):
+    return {"__datetime__": value.isoformat()}
+  if isinstance(value, bytes):
+    return {"__bytes__": base64.b64encode(value).decode()}
+  if isinstance(value, dict):
+    return {key: encode(item) for key, item in value.items()}
+  if isinstance(value, (list, tuple)):
+    return [encode(item) for item in value]
+  return value
+
+def decode(value):
+  if isinstance(value, dict):
+    if ("__datetime__" in value):
+      return datetime.datetime.fromisoformat(value["__datetime__"])
+    if ("__bytes__" in value):
+      return base64.b64decode(value["__bytes__"])
+    return {key: decode(item) for key, item in value.items()}
+  if isinstance(value, list):
+    return [decode(item) for item in value]
+  return value
+
+def redact(aws_service: str, operation: str, response: dict) -> dict:
+  if ((aws_service == "sts") and ("Credentials" in response)):
+    for field in ["AccessKeyId", "SecretAccessKey", "SessionToken"]:
+      response["Credentials"][field] = redacted
+  if ((aws_service == "secretsmanager") and ("SecretString" in response)):
+    try:
+      secret = json.loads(response["SecretString"])
+      for key in secret:
+        if any(word in key.lower() for word in sensitive_words):
+          secret[key] = redacted
+      response["SecretString"] = json.dumps(secret)
+    except ValueError:
+      response["SecretString"] = redacted
+  if ((aws_service == "ecr") and ("authorizationData" in response)):
+    for authorization in response["authorizationData"]:
+      authorization["authorizationToken"] = base64.b64encode(("AWS:" + redacted).encode()).decode()
+  if (aws_service == "ssm"):
+    for parameter in ([response["Parameter"]] if ("Parameter" in response) else []) + response.get("Parameters", []):
+      if (parameter.get("Type") == "SecureString"):
+        parameter["Value"] = redacted
+  return response
+
+# Every entry is tagged with the step (script and process) that made the call,
+# so that a replay only follows the timeline of the step being replayed.
+def step_marker() -> str:
+  return instrumentation.script_name() + ":" + str(os.getpid())
+
+def requested_id(element) -> str:
+  if isinstance(element, dict):
+    return element.get("imageDigest") or element.get("imageTag")
+  return element
+
+def parameters_key(aws_service: str, operation: str, params: dict) -> str:
+  return aws_service + "." + operation + ":" + json.dumps(encode(params), sort_keys=True, separators=(",", ":"))
+
+class Recorder:
+  def __init__(self, path: str):
+    self.path = path
+    self.lock = threading.Lock()
+
+  def install(self, session):
+    session.events.register("before-parameter-build", capture_parameters)
+    session.events.register("after-call", self.record)
+
+  def record(self, http_response, parsed, model, context, **kwargs):
+    aws_service = model.service_model.service_name
+    response = redact(aws_service, model.name, decode(encode(parsed)))
+    response.pop("ResponseMetadata", None)
+    entry = {
+      "t": round(polling.clock.wall(), 3),
+      "step": step_marker(),
+      "service": aws_service,
+      "operation": model.name,
+      "params": encode(context.get("cassette_params", {})),
+      "status": http_response.status_code,
+      "response": encode(response),
+    }
+    with self.lock:
+      os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+      with open(self.path, "a") as file:
+        file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+class ReplayHttpResponse:
+  def __init__(self, status_code: int):
+    self.status_code = status_code
+    self.headers = {}
+    self.content = b""
+    self.raw = None
+
+class ReplayClock(polling.Clock):
+  def __init__(self, speed: float):
+    self.speed = speed
+    self.time = 0.0
+    self.origin = 0.0
+
+  def now(self) -> float:
+    return self.time
+
+  def wall(self) -> float:
+    return self.origin + self.time
+
+  def sleep(self, seconds: float):
+    self.time += seconds
+    if (self.speed > 0):
+      time.sleep(seconds / self.speed)
+
+  # No jitter, so that every replay polls at the same points in time
+  def uniform(self, low: float, high: float) -> float:
+    return (low + high) / 2
+
+# Replays the entries of one step: the first recorded step of the script being
+# run, or the one named by DEPLOYMENT_CASSETTE_STEP. Virtual time starts at that
+# step's first entry. Calls the step never recorded (such as a secret another
+# step had already cached on disk) are answered from the other steps with the
+# latest entry recorded before the same point in time. Calls for a list of IDs
+# are only matched exactly or rebuilt from per ID results (see
+# id_list_operations), anything else falls back to any call of the operation.
+class Player:
+  def __init__(self, path: str, clock: ReplayClock, step: str = None):
+    self.clock = clock
+    self.lock = threading.Lock()
+    self.times = {}
+    entries = []
+    with open(path, "r") as file:
+      for line in file:
+        if (line.strip() != ""):
+          entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry["t"])
+    if (step is None):
+      step = next((entry["step"] for entry in entries if entry.get("step", "").split(":")[0] == instrumentation.script_name()), None)
+    step_entries = [entry for entry in entries if entry.get("step") == step]
+    if (len(step_entries) == 0):
+      logging.warning("The cassette has no step recorded for " + instrumentation.script_name() + ", replaying every entry")
+      step_entries = entries
+    self.origin = step_entries[0]["t"] if (len(step_entries) > 0) else 0
+    self.clock.origin = self.origin
+    self.step_index = self.index(step_entries)
+    self.fallback_index = self.index(entries)
+
+  def index(self, entries: list) -> tuple:
+    by_parameters = {}
+    by_operation = {}
+    by_id = {}
+    for entry in entries:
+      operation = entry["service"] + "." + entry["operation"]
+      by_parameters.setdefault(parameters_key(entry["service"], entry["operation"], decode(entry["params"])), []).append(entry)
+      by_operation.setdefault(operation, []).append(entry)
+      if (operation in id_list_operations):
+        request_field, response_field, item_ids = id_list_operations[operation]
+        for item in entry["response"].get(response_field, []):
+          for item_id in item_ids(item):
+            by_id.setdefault((operation, item_id), []).append({"t": entry["t"], "item": item})
+    for indexed_entries in list(by_parameters.values()) + list(by_operation.values()) + list(by_id.values()):
+      self.times[id(indexed_entries)] = [entry["t"] for entry in indexed_entries]
+    return by_parameters, by_operation, by_id
+
+  def install(self, session):
+    session.events.register("before-parameter-build", capture_parameters)
+    session.events.register("before-call", self.respond)
+
+  def find(self, index: tuple, aws_service: str, operation: str, params: dict, exact: bool) -> list:
+    by_parameters, by_operation, by_id = index
+    entries = by_parameters.get(parameters_key(aws_service, operation, params))
+    if ((entries is None) and (not exact)):
+      entries = by_operation.get(aws_service + "." + operation)
+    return entries
+
+  # The latest entry recorded at or before the current point of the replay, or
+  # the first one if the replay is still ahead of every recording.
+  def latest(self, entries: list) -> dict:
+    with self.lock:
+      index = bisect.bisect_right(self.times[id(entries)], self.origin + self.clock.now()) - 1
+    return entries[max(index, 0)]
+
+  def compose(self, operation: str, params: dict) -> dict:
+    request_field, response_field, item_ids = id_list_operations[operation]
+    items = []
+    for element in params[request_field]:
+      entries = self.step_index[2].get((operation, requested_id(element))) or self.fallback_index[2].get((operation, requested_id(element)))
+      if (not entries):
+        raise LookupError("The cassette has no recording of " + operation + " for " + str(requested_id(element)))
+      items.append(self.latest(entries)["item"])
+    template = self.latest(self.step_index[1].get(operation) or self.fallback_index[1][operation])
+    response = dict(template["response"])
+    response[response_field] = items
+    for field in ["failures", "InvalidParameters"]:
+      if (field in response):
+        response[field] = []
+    return {"status": template["status"], "response": response}
+
+  def respond(self, model, context, **kwargs):
+    aws_service = model.service_model.service_name
+    operation = aws_service + "." + model.name
+    params = context.get("cassette_params", {})
+    exact = (operation in id_list_operations) and (id_list_operations[operation][0] in params)
+    entries = self.find(self.step_index, aws_service, model.name, params, exact) or self.find(self.fallback_index, aws_service, model.name, params, exact)
+    if (entries):
+      entry = self.latest(entries)
+    elif (exact):
+      entry = self.compose(operation, params)
+    else:
+      raise LookupError("The cassette has no recording of " + operation)
+    response = decode(entry["response"])
+    response["ResponseMetadata"] = {"HTTPStatusCode": entry["status"], "RetryAttempts": 0}
+    return ReplayHttpResponse(entry["status"]), response
+
+def capture_parameters(params, context, **kwargs):
+  context["cassette_params"] = decode(encode(params))
+
+def install(session):
+  if (mode() == "record"):
+    Recorder(cassette_path()).install(session)
+  elif (mode() == "replay"):
+    os.environ["DEPLOYMENT_CACHE"] = "off"
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+    clock = ReplayClock(speed=float(os.environ.get("DEPLOYMENT_CASSETTE_SPEED", 0)))
+    polling.set_clock(clock)
+    Player(cassette_path(), clock, step=os.environ.get("DEPLOYMENT_CASSETTE_STEP")).install(session)
+    logging.info("Replaying AWS responses from cassette: " + cassette_path())
+
+def main(argv: list = None):
+  parser = argparse.ArgumentParser(description="AWS Cassette Replay Script")
+
+  parser.add_argument("--replay", type=str, required=True, help="The cassette to replay")
+  parser.add_argument("--speed", default=0, type=float, help="How many times faster than real time to replay, 0 skips waiting entirely")
+  parser.add_argument("--step", type=str, help="The step to replay as script:pid, defaults to the first recorded step of the script")
+  parser.add_argument("script", type=str, help="The deployment script to run, e.g. track_deployment.py")
+  parser.add_argument("arguments", nargs=argparse.REMAINDER, help="The arguments passed to the script")
+
+  args = parser.parse_args(argv)
+
+  os.environ["DEPLOYMENT_CASSETTE_MODE"] = "replay"
+  os.environ["DEPLOYMENT_CASSETTE"] = os.path.abspath(args.replay)
+  os.environ["DEPLOYMENT_CASSETTE_SPEED"] = str(args.speed)
+  if (args.step):
+    os.environ["DEPLOYMENT_CASSETTE_STEP"] = args.step
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.basename(args.script))
+  sys.argv = [script] + args.arguments
+  runpy.run_path(script, run_name="__main__")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,115 @@
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Every deployment script behind one entry point. A script is only imported
+# when its subcommand runs, so each step loads boto3 and prometheus_client only
+# if it actually uses them.
+commands = {
+  "fetch-version": ("versioning", ["--fetch"]),
+  "save-version": ("versioning", ["--save"]),
+  "ecr-auth": ("ecr_authenticate", []),
+  "track": ("track_deployment", []),
+  "scan": ("image_scan", []),
+  "purge": ("purge_image", []),
+  "stop": ("stop_service", []),
+  "report": ("pipeline_reporting", []),
+  "preflight": ("preflight", []),
+  "flush-metrics": ("metrics_spool", ["--flush"]),
+}
+
+# The heavy modules each subcommand may load at import time and how many
+# milliseconds a fresh interpreter may take to import it, checked by
+# check-imports (the budgets can be scaled for slower runners). boto3, botocore
+# and prometheus_client are only imported once a call or push is made, so no
+# subcommand may load them up front.
+heavy_modules = ["boto3", "botocore", "prometheus_client"]
+import_budgets = {
+  "fetch-version": ([], 200),
+  "save-version": ([], 200),
+  "ecr-auth": ([], 200),
+  "track": ([], 200),
+  "scan": ([], 200),
+  "purge": ([], 200),
+  "stop": ([], 200),
+  "report": ([], 200),
+  "preflight": ([], 200),
+  "flush-metrics": ([], 200),
+}
+dispatch_budget = 100
+
+def run(command: str, arguments: list):
+  module_name, default_arguments = commands[command]
+  module = importlib.import_module(module_name)
+  sys.argv = [module_name + ".py"] + arguments
+  module.main(default_arguments + arguments)
+
+def loaded_modules(command: str) -> list:
+  if (command != "dispatch"):
+    importlib.import_module(commands[command][0])
+  return [module for module in heavy_modules if module in sys.modules]
+
+# Each subcommand is imported in a fresh interpreter and timed from the outside,
+# interpreter start up included, as that is what every workflow step pays.
+def check_imports(scale: float) -> int:
+  failures = []
+  budgets = dict(import_budgets)
+  budgets["dispatch"] = ([], dispatch_budget)
+  for command, (allowed_modules, budget) in budgets.items():
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, sys.argv[0], "loaded-modules", command], capture_output=True, text=True, check=True).stdout
+    milliseconds = (time.perf_counter() - started) * 1000
+    modules = json.loads(output)
+    unexpected_modules = [module for module in modules if module not in allowed_modules]
+    print("%-14s %7.1f ms (budget %d ms) %s" % (command, milliseconds, (budget * scale), ", ".join(modules)))
+    if (milliseconds > (budget * scale)):
+      failures.append(command + " took " + str(round(milliseconds, 1)) + " ms to start")
+    if (len(unexpected_modules) > 0):
+      failures.append(command + " imported " + ", ".join(unexpected_modules))
+  for failure in failures:
+    print("Over budget: " + failure)
+  return 1 if (len(failures) > 0) else 0
+
+# Packs the scripts into a single zipapp. zipimport cannot write bytecode caches
+# so the modules are precompiled, with unchecked hashes, for the interpreter
+# running the build.
+def build(output: str):
+  import py_compile
+  import shutil
+  import tempfile
+  import zipapp
+  source_directory = os.path.dirname(os.path.abspath(__file__))
+  with tempfile.TemporaryDirectory() as build_directory:
+    for filename in sorted(os.listdir(source_directory)):
+      if (not filename.endswith(".py")):
+        continue
+      shutil.copy(os.path.join(source_directory, filename), build_directory)
+      py_compile.compile(os.path.join(source_directory, filename), cfile=os.path.join(build_directory, filename + "c"), dfile=filename, doraise=True, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+    with open(os.path.join(build_directory, "__main__.py"), "w") as file:
+      file.write("import deployctl\ndeployctl.main()\n")
+    zipapp.create_archive(build_directory, target=output, interpreter="/usr/bin/env python3")
+  print("Built " + output)
+
+def main(argv: list = None):
+  parser = argparse.ArgumentParser(prog="deployctl", description="Deployment Scripts Entry Point")
+
+  parser.add_argument("command", choices=(list(commands) + ["build", "check-imports", "loaded-modules"]), help="The subcommand to run, any further arguments are passed on to it")
+  parser.add_argument("arguments", nargs=argparse.REMAINDER, help="The arguments of the subcommand, see deployctl <command> --help")
+
+  args = parser.parse_args(argv)
+
+  if (args.command == "build"):
+    build(output=(args.arguments[0] if args.arguments else "deployctl.pyz"))
+  elif (args.command == "check-imports"):
+    exit(check_imports(scale=(float(args.arguments[0]) if args.arguments else 1)))
+  elif (args.command == "loaded-modules"):
+    print(json.dumps(loaded_modules(args.arguments[0])))
+  else:
+    run(args.command, args.arguments)
+
+if __name__ == "__main__":
+  main()
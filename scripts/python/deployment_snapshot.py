@@ -0,0 +1,72 @@
+import datetime
+
+# Compact views of a describe_services response. They are built once per API
+# response, index deployments by id and can be compared with the snapshot of
+# the previous poll so that only changes have to be reported.
+class DeploymentSnapshot:
+  __slots__ = ("id", "status", "task_definition", "created_at", "rollout_state", "desired_count", "running_count", "pending_count", "failed_tasks")
+
+  tracked_fields = ("status", "rollout_state", "desired_count", "running_count", "pending_count", "failed_tasks")
+
+  def __init__(self, deployment: dict):
+    self.id = deployment["id"]
+    self.status = deployment.get("status")
+    self.task_definition = deployment.get("taskDefinition")
+    self.created_at = deployment.get("createdAt", datetime.datetime.min)
+    self.rollout_state = deployment.get("rolloutState")
+    self.desired_count = deployment.get("desiredCount", 0)
+    self.running_count = deployment.get("runningCount", 0)
+    self.pending_count = deployment.get("pendingCount", 0)
+    self.failed_tasks = deployment.get("failedTasks", 0)
+
+  def diff(self, previous) -> dict:
+    changes = {}
+    for field in self.tracked_fields:
+      current_value = getattr(self, field)
+      previous_value = None
+      if (previous is not None):
+        previous_value = getattr(previous, field)
+      if ((previous is None) or (current_value != previous_value)):
+        changes[field] = (previous_value, current_value)
+    return changes
+
+class ServiceSnapshot:
+  __slots__ = ("cluster", "service_name", "status", "desired_count", "running_count", "pending_count", "deployments", "ordered_deployments", "events")
+
+  def __init__(self, described_service: dict, cluster: str = None):
+    self.cluster = cluster
+    self.service_name = described_service.get("serviceName")
+    self.status = described_service.get("status")
+    self.desired_count = described_service.get("desiredCount", 0)
+    self.running_count = described_service.get("runningCount", 0)
+    self.pending_count = described_service.get("pendingCount", 0)
+    self.ordered_deployments = sorted([DeploymentSnapshot(deployment) for deployment in described_service.get("deployments", [])], key=lambda x: x.created_at, reverse=True)
+    self.deployments = {deployment.id: deployment for deployment in self.ordered_deployments}
+    self.events = described_service.get("events", [])
+
+  def deployment(self, deployment_id: str) -> DeploymentSnapshot:
+    return self.deployments.get(deployment_id)
+
+  def newest(self) -> DeploymentSnapshot:
+    return self.ordered_deployments[0]
+
+  def oldest(self) -> DeploymentSnapshot:
+    return self.ordered_deployments[-1]
+
+  def diff(self, previous, deployment_id: str) -> dict:
+    deployment = self.deployment(deployment_id)
+    if (deployment is None):
+      return {}
+    previous_deployment = None
+    if (previous is not None):
+      previous_deployment = previous.deployment(deployment_id)
+    return deployment.diff(previous_deployment)
+
+def format_changes(changes: dict) -> str:
+  formatted_changes = []
+  for field, (previous_value, current_value) in changes.items():
+    if (previous_value is None):
+      formatted_changes.append(field + "(" + str(current_value) + ")")
+    else:
+      formatted_changes.append(field + "(" + str(previous_value) + " -> " + str(current_value) + ")")
+  return " ".join(formatted_changes)
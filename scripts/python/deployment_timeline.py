@@ -0,0 +1,63 @@
+# The milestones of one tracked deployment, in seconds since the deployment was
+# created (or since tracking started when ECS does not report it). Milestones
+# seen by polling are only as precise as the polling interval, which is enough
+# to compare services and follow trends across deploys.
+class DeploymentTimeline:
+  milestones = ("first_pending", "first_running", "steady_state", "revert_started", "revert_finished")
+
+  def __init__(self, cluster: str, service: str, environment: str, deployment_id: str, task_definition: str, started: float):
+    self.cluster = cluster
+    self.service = service
+    self.environment = environment
+    self.deployment_id = deployment_id
+    self.task_definition = task_definition
+    self.started = started
+    self.times = {}
+    self.exit_code = None
+    self.finished = None
+
+  def mark(self, milestone: str, now: float):
+    if (milestone not in self.times):
+      self.times[milestone] = round(now - self.started, 1)
+
+  def observe(self, deployment, now: float):
+    if ((deployment.pending_count > 0) or (deployment.running_count > 0)):
+      self.mark("first_pending", now)
+    if (deployment.running_count > 0):
+      self.mark("first_running", now)
+
+  def finish(self, exit_code: int, now: float):
+    self.exit_code = exit_code
+    self.finished = round(now - self.started, 1)
+
+  def revert_duration(self) -> float:
+    if (("revert_started" not in self.times) or ("revert_finished" not in self.times)):
+      return None
+    return round(self.times["revert_finished"] - self.times["revert_started"], 1)
+
+  def as_dict(self) -> dict:
+    timeline = {
+      "cluster": self.cluster,
+      "service": self.service,
+      "environment": self.environment,
+      "deployment_id": self.deployment_id,
+      "task_definition": self.task_definition,
+      "exit_code": self.exit_code,
+      "tracked_seconds": self.finished,
+      "revert_seconds": self.revert_duration(),
+    }
+    for milestone in self.milestones:
+      timeline[milestone + "_seconds"] = self.times.get(milestone)
+    return timeline
+
+  # Gauges for the metrics spool, milestones that were never reached are left
+  # out rather than reported as zero.
+  def gauges(self) -> list:
+    labels = {"instance": self.environment, "service": self.service}
+    values = [
+      ("deployment_time_to_first_pending_seconds", "The seconds from the creation of the deployment until it had a pending task", self.times.get("first_pending")),
+      ("deployment_time_to_first_running_seconds", "The seconds from the creation of the deployment until it had a running task", self.times.get("first_running")),
+      ("deployment_time_to_steady_state_seconds", "The seconds from the creation of the deployment until the rollout completed", self.times.get("steady_state")),
+      ("deployment_revert_seconds", "The seconds spent reverting a failed rollout", self.revert_duration()),
+    ]
+    return [(name, documentation, labels, value) for name, documentation, value in values if value is not None]
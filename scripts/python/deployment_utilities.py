@@ -1,31 +1,151 @@
-import boto3
 import json
-from prometheus_client.exposition import basic_auth_handler
+import logging
+import os
+import threading
+import time
+from ttl_cache import TTLCache
+import instrumentation
+import cassette
 
 push_gateway_url = "https://push.mgmt.adimo.co"
 
+# Assumed role credentials are keyed by account and reused by every step of a
+# job until shortly before they expire, secrets are kept for a fixed TTL.
+credential_cache = TTLCache("credentials", margin=int(os.environ.get("DEPLOYMENT_CREDENTIAL_MARGIN", 600)))
+secret_cache = TTLCache("secrets")
+secret_ttl = int(os.environ.get("DEPLOYMENT_SECRET_TTL", 900))
+
+# Every client is created from one shared session so that service models and
+# endpoint data are only loaded once, and clients (with their connection pools)
+# are reused for the same service, account and region.
+max_pool_connections = int(os.environ.get("DEPLOYMENT_MAX_POOL_CONNECTIONS", 25))
+retry_mode = os.environ.get("DEPLOYMENT_RETRY_MODE", "adaptive")
+retry_max_attempts = int(os.environ.get("DEPLOYMENT_RETRY_MAX_ATTEMPTS", 10))
+
+aws_session = None
+aws_clients = {}
+client_lock = threading.Lock()
+
 def switch_role(account: str, session_name: str):
-  sts_client = boto3.client("sts")
+  return credential_cache.get_or_create(account, lambda: assume_role(account=account, session_name=session_name))
+
+def assume_role(account: str, session_name: str):
+  sts_client = get_aws_client("sts")
   role_arn = "arn:aws:iam::" + fetch_account_number(account) + ":role/CI"
-  role_session_name = session_name
-  return sts_client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)["Credentials"]
+  with instrumentation.phase("assume-role"):
+    credentials = sts_client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)["Credentials"]
+  expiration = credentials["Expiration"]
+  credentials["Expiration"] = expiration.isoformat()
+  return credentials, expiration.timestamp()
+
+def fetch_adimo_config() -> dict:
+  return secret_cache.get_or_create("/adimo/terraform", read_adimo_config)
+
+def read_adimo_config():
+  sm_client = get_aws_client("secretsmanager")
+  with instrumentation.phase("fetch-secret"):
+    adimo_config = sm_client.get_secret_value(SecretId="/adimo/terraform")
+  return json.loads(adimo_config["SecretString"]), (time.time() + secret_ttl)
 
 def fetch_account_number(account: str):
-  sm_client = boto3.client("secretsmanager")
-  adimo_config = sm_client.get_secret_value(SecretId="/adimo/terraform")
-  adimo_config_json = json.loads(adimo_config["SecretString"])
-  return adimo_config_json[(account + "_account")]
-
-def get_aws_client(aws_service: str, credentials: dict):
-  return boto3.client(
-    aws_service,
-    aws_access_key_id=credentials['AccessKeyId'],
-    aws_secret_access_key=credentials['SecretAccessKey'],
-    aws_session_token=credentials['SessionToken'],
+  return fetch_adimo_config()[(account + "_account")]
+
+# boto3, botocore and prometheus_client are imported when first needed, so that
+# steps which never make a call (or never push metrics) start quickly.
+def get_session():
+  global aws_session
+  with client_lock:
+    if (aws_session is None):
+      import boto3
+      aws_session = boto3.session.Session()
+      instrumentation.install(aws_session)
+      cassette.install(aws_session)
+    return aws_session
+
+def client_config():
+  from botocore.config import Config
+  return Config(
+    max_pool_connections=max_pool_connections,
+    retries={"mode": retry_mode, "max_attempts": retry_max_attempts},
   )
 
+def get_aws_client(aws_service: str, credentials: dict = None, account: str = None, region: str = None):
+  access_key_id = None
+  if (credentials is not None):
+    access_key_id = credentials['AccessKeyId']
+  key = (aws_service, account or access_key_id, region)
+  shared_session = get_session()
+  with client_lock:
+    if ((key in aws_clients) and (aws_clients[key][0] == access_key_id)):
+      return aws_clients[key][1]
+    arguments = {}
+    if (credentials is not None):
+      arguments["aws_access_key_id"] = credentials['AccessKeyId']
+      arguments["aws_secret_access_key"] = credentials['SecretAccessKey']
+      arguments["aws_session_token"] = credentials['SessionToken']
+    client = shared_session.client(aws_service, region_name=region, config=client_config(), **arguments)
+    aws_clients[key] = (access_key_id, client)
+    return client
+
+def get_account_client(aws_service: str, account: str, session_name: str, region: str = None):
+  credentials = switch_role(account=account, session_name=session_name)
+  return get_aws_client(aws_service, credentials, account=account, region=region)
+
+# Services may be given as "service" (using the default cluster) or as
+# "cluster/service".
+def parse_service_targets(services: list, default_cluster: str) -> list:
+  targets = []
+  for service in services:
+    if ("/" in service):
+      cluster, service = service.split("/", 1)
+      targets.append((cluster, service))
+    else:
+      targets.append((default_cluster, service))
+  return targets
+
+def group_by_cluster(targets: list) -> dict:
+  clusters = {}
+  for cluster, service in targets:
+    clusters.setdefault(cluster, []).append(service)
+  return clusters
+
+def describe_services_batched(ecs, cluster: str, services: list) -> dict:
+  described_services = {}
+  for i in range(0, len(services), 10):
+    response = ecs.describe_services(cluster=cluster, services=services[i:(i + 10)])
+    for described_service in response["services"]:
+      described_services[described_service["serviceName"]] = described_service
+    for failure in response.get("failures", []):
+      logging.warning("Unable to describe service: " + failure.get("arn", "") + " (" + failure.get("reason", "") + ")")
+  return described_services
+
+# startedBy cannot be combined with any other list_tasks filter, so stopped
+# tasks are listed per service and filtered by startedBy once described.
+def list_stopped_tasks(ecs, cluster: str, service: str) -> list:
+  task_arns = []
+  paginator = ecs.get_paginator("list_tasks")
+  for page in paginator.paginate(cluster=cluster, serviceName=service, desiredStatus="STOPPED", PaginationConfig={"PageSize": 100}):
+    task_arns.extend(page["taskArns"])
+  return task_arns
+
+def describe_tasks_batched(ecs, cluster: str, task_arns: list) -> list:
+  described_tasks = []
+  for i in range(0, len(task_arns), 100):
+    response = ecs.describe_tasks(cluster=cluster, tasks=task_arns[i:(i + 100)])
+    described_tasks.extend(response["tasks"])
+    for failure in response.get("failures", []):
+      logging.warning("Unable to describe task: " + failure.get("arn", "") + " (" + failure.get("reason", "") + ")")
+  return described_tasks
+
+def list_repositories(ecr) -> list:
+  repositories = []
+  paginator = ecr.get_paginator("describe_repositories")
+  for page in paginator.paginate(PaginationConfig={"PageSize": 1000}):
+    for repository in page["repositories"]:
+      repositories.append(repository["repositoryName"])
+  return repositories
+
 def push_gateway_handler(url, method, timeout, headers, data):
-  sm_client = boto3.client("secretsmanager")
-  adimo_config = sm_client.get_secret_value(SecretId="/adimo/terraform")
-  adimo_config_json = json.loads(adimo_config["SecretString"])
+  from prometheus_client.exposition import basic_auth_handler
+  adimo_config_json = fetch_adimo_config()
   return basic_auth_handler(url, method, timeout, headers, data, adimo_config_json["push_gateway_username"], adimo_config_json["push_gateway_password"])
@@ -1,27 +1,28 @@
-import boto3
 from deployment_utilities import *
+from ecr_token_provider import get_tokens, merge_tfvars
 import logging
 import argparse
-import base64
 
-def create_tfvars(environment: str):
-  credentials = switch_role(account=environment, session_name="IterateVersionSession")
-  ecr = get_aws_client("ecr", credentials)
-  auth_token = ecr.get_authorization_token(registryIds=[fetch_account_number(environment)])["authorizationData"][0]["authorizationToken"]
-  auth_token = base64.b64decode(auth_token).decode().split(":")[1]
-  with open("terraform.tfvars", "w") as file:
-    file.write("docker_password = \"" + auth_token + "\"")  
+def create_tfvars(environments: list, path: str = "terraform.tfvars"):
+  tokens = get_tokens(environments)
+  variables = {"docker_password": tokens[environments[0]]["password"]}
+  if (len(environments) > 1):
+    for environment in environments:
+      variables["docker_password_" + environment] = tokens[environment]["password"]
+  merge_tfvars(path, variables)
+  logging.info("Updated " + ", ".join(variables) + " in " + path)
 
-def main():
+def main(argv: list = None):
   parser = argparse.ArgumentParser(description="AWS ECR Authentication Script")
 
-  parser.add_argument("--environment", type=str, required=True, help="The name of the environment we are interacting with")
+  parser.add_argument("--environment", type=str, nargs='+', required=True, help="The names of the environments to authenticate with, the first one is written as docker_password and every one as docker_password_<environment> when there is more than one")
+  parser.add_argument("--tfvars", default="terraform.tfvars", type=str, help="The tfvars file the tokens are merged into")
 
-  args = parser.parse_args()
+  args = parser.parse_args(argv)
 
   logging.getLogger().setLevel("INFO")
 
-  create_tfvars(environment=args.environment)
+  create_tfvars(environments=args.environment, path=args.tfvars)
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,61 @@
+from deployment_utilities import get_account_client, fetch_account_number, get_session
+from ttl_cache import TTLCache, persistent_cache_directory
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+# ECR tokens are valid for 12 hours, so they are cached (0600, outside of the
+# job directory) until shortly before they expire. The cache outlives the job,
+# so it is keyed by the base credentials as well as the environment: a token is
+# only served to the access key that requested it. The key is built from local
+# values, so a hit needs no STS, Secrets Manager or ECR call.
+token_cache = TTLCache("ecr-tokens", directory=persistent_cache_directory(), margin=int(os.environ.get("DEPLOYMENT_ECR_TOKEN_MARGIN", 1800)))
+
+def get_token(environment: str) -> dict:
+  return token_cache.get_or_create(token_key(environment), lambda: request_token(environment=environment))
+
+def token_key(environment: str) -> str:
+  credentials = get_session().get_credentials()
+  access_key_id = credentials.access_key if (credentials is not None) else "anonymous"
+  caller = hashlib.sha256((access_key_id + ":" + environment).encode()).hexdigest()
+  return environment + ":" + caller
+
+def get_tokens(environments: list) -> dict:
+  with ThreadPoolExecutor(max_workers=max(1, len(environments))) as executor:
+    return dict(zip(environments, executor.map(get_token, environments)))
+
+def request_token(environment: str):
+  logging.info("Requesting a new ECR authorization token for environment: " + environment)
+  ecr = get_account_client("ecr", account=environment, session_name="IterateVersionSession")
+  authorization = ecr.get_authorization_token(registryIds=[fetch_account_number(environment)])["authorizationData"][0]
+  username, password = base64.b64decode(authorization["authorizationToken"]).decode().split(":", 1)
+  token = {"username": username, "password": password, "proxy_endpoint": authorization["proxyEndpoint"]}
+  return token, authorization["expiresAt"].timestamp()
+
+# Replaces (or adds) the given variables in a tfvars file, leaving every other
+# line as it was.
+def merge_tfvars(path: str, variables: dict):
+  lines = []
+  if (os.path.isfile(path)):
+    with open(path, "r") as file:
+      lines = file.read().splitlines()
+  remaining = dict(variables)
+  for index, line in enumerate(lines):
+    match = re.match(r"^\s*([A-Za-z0-9_-]+)\s*=", line)
+    if ((match is not None) and (match.group(1) in remaining)):
+      lines[index] = format_tfvar(match.group(1), remaining.pop(match.group(1)))
+  for name, value in remaining.items():
+    lines.append(format_tfvar(name, value))
+  directory = os.path.dirname(os.path.abspath(path))
+  descriptor, temporary_path = tempfile.mkstemp(dir=directory)
+  with os.fdopen(descriptor, "w") as file:
+    file.write("\n".join(lines) + "\n")
+  os.chmod(temporary_path, 0o600)
+  os.replace(temporary_path, path)
+
+def format_tfvar(name: str, value: str) -> str:
+  return name + " = \"" + value + "\""
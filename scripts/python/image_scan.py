@@ -1,73 +1,164 @@
-import boto3
 from deployment_utilities import *
-from prometheus_client import Gauge, CollectorRegistry, push_to_gateway
+from polling import poll, PollTimeout
+from metrics_spool import record_gauges, flush
 import logging
 import argparse
-import base64
-import time
-import math
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+scan_timeout = 1800
+push_immediately = False
+scan_categories = ["INFORMATIONAL", "LOW", "MEDIUM", "HIGH", "CRITICAL", "UNDEFINED"]
+
+# Assumed role credentials may be shared by an earlier step of the job, so long
+# waits fetch the client on every poll (or for every repository) and pick up
+# renewed credentials before the old ones expire.
+def ecr_client(environment: str):
+  return get_account_client("ecr", account=environment, session_name="IterateVersionSession")
 
 def image_scan(service:str, environment: str):
-  credentials = switch_role(account=environment, session_name="IterateVersionSession")
-  ecr = get_aws_client("ecr", credentials)
+  ecr = ecr_client(environment)
   logging.info("Retrieving latest image to scan")
-  image_details = ecr.describe_images(repositoryName=service)["imageDetails"]
-  image_details.sort(key = lambda x:x["imagePushedAt"], reverse=True)
-  image_digest = image_details[0]["imageDigest"]
-  if "imageScanStatus" in image_details[0]:
-    if "status" in image_details[0]["imageScanStatus"]:
-      if image_details[0]["imageScanStatus"]["status"] == "COMPLETE":
-        logging.warning("Image scan already completed")
-        print_image_scan_findings(ecr=ecr, service=service, environment=environment)
-        exit(0)
-      elif image_details[0]["imageScanStatus"]["status"] == "IN_PROGRESS":
-        logging.warning("Image scan was already started")
-      else:
-        logging.error("Image scan status error")
-        logging.error("Image scan status: (" + image_details[0]["imageScanStatus"]["status"] + ")")
-        exit(1)
-
-  imageId = {}
-  imageId["imageDigest"] = image_digest
-  result = ecr.start_image_scan(repositoryName=service, imageId=imageId)
-  scan_status = retrieve_image_scan_status(ecr=ecr, service=service)
-  i = 0
-  while(scan_status != "COMPLETE"):
-    logging.info("Polling image scan state [" + str(math.floor((i*5)/60)) + "m" + str((i*5)%60) + "s]")
-    time.sleep(5)
-    scan_status = retrieve_image_scan_status(ecr=ecr, service=service)
-    if ((scan_status != "COMPLETE") and (scan_status != "IN_PROGRESS")):
-      logging.error("Failure scanning image, reason: " + scan_status)
-      exit(1)
-    i = i + 1
+  image_detail = find_latest_image(ecr=ecr, service=service)
+  if (image_detail is None):
+    logging.error("No images found in repository: " + service)
+    exit(1)
+  image_digest = image_detail["imageDigest"]
+  scan_status = image_detail.get("imageScanStatus", {}).get("status")
+  if (scan_status == "COMPLETE"):
+    logging.warning("Image scan already completed")
+    print_image_scan_findings(image_detail=image_detail, service=service, environment=environment)
+    exit(0)
+  elif (scan_status in ["IN_PROGRESS", "PENDING"]):
+    logging.warning("Image scan was already started")
+  elif (scan_status is None):
+    ecr.start_image_scan(repositoryName=service, imageId={"imageDigest": image_digest})
+  else:
+    logging.error("Image scan status error")
+    logging.error("Image scan status: (" + scan_status + ")")
+    exit(1)
+
+  try:
+    image_detail = wait_for_image_scan(environment=environment, service=service, image_digest=image_digest)
+  except PollTimeout as error:
+    logging.error(str(error))
+    exit(1)
+  scan_status = parse_image_scan_status(image_detail=image_detail)
+  if (scan_status != "COMPLETE"):
+    logging.error("Failure scanning image, reason: " + scan_status)
+    exit(1)
   logging.info("Image scan complete, results are as follows")
-  print_image_scan_findings(ecr=ecr, service=service, environment=environment)
-  
-def retrieve_image_scan_status(ecr:boto3.client, service:str) -> str:
-  image_details = ecr.describe_images(repositoryName=service)["imageDetails"]
-  image_details.sort(key = lambda x:x["imagePushedAt"], reverse=True)
-  if "imageScanStatus" in image_details[0]:
-    if "status" in image_details[0]["imageScanStatus"]:
-      return image_details[0]["imageScanStatus"]["status"]
+  print_image_scan_findings(image_detail=image_detail, service=service, environment=environment)
+
+def wait_for_image_scan(environment:str, service:str, image_digest:str, description:str = "image scan state") -> dict:
+  def check_scan():
+    image_detail = describe_image(ecr=ecr_client(environment), service=service, image_digest=image_digest)
+    if (parse_image_scan_status(image_detail=image_detail) in ["IN_PROGRESS", "PENDING"]):
+      return None
+    return image_detail
+
+  return poll(check_scan, description, timeout=scan_timeout, initial_interval=3, max_interval=15, phase="poll-image-scan")
+
+# Walks every page of the repository once, keeping only the newest image, so the
+# result is correct however many images the repository holds.
+def find_latest_image(ecr, service:str) -> dict:
+  latest_image = None
+  paginator = ecr.get_paginator("describe_images")
+  for page in paginator.paginate(repositoryName=service, PaginationConfig={"PageSize": 1000}):
+    for image_detail in page["imageDetails"]:
+      if ((latest_image is None) or (image_detail["imagePushedAt"] > latest_image["imagePushedAt"])):
+        latest_image = image_detail
+  return latest_image
+
+def describe_image(ecr, service:str, image_digest:str) -> dict:
+  return ecr.describe_images(repositoryName=service, imageIds=[{"imageDigest": image_digest}])["imageDetails"][0]
+
+def parse_image_scan_status(image_detail: dict) -> str:
+  if "imageScanStatus" in image_detail:
+    if "status" in image_detail["imageScanStatus"]:
+      return image_detail["imageScanStatus"]["status"]
   return "ERROR"
 
-def print_image_scan_findings(ecr:boto3.client, service:str, environment: str):
-  image_details = ecr.describe_images(repositoryName=service)["imageDetails"]
-  image_details.sort(key = lambda x:x["imagePushedAt"], reverse=True)
-  if "imageScanFindingsSummary" in image_details[0]:
-    if "findingSeverityCounts" in image_details[0]["imageScanFindingsSummary"]:
-      print(image_details[0]["imageScanFindingsSummary"]["findingSeverityCounts"])
-      push_results(service=service, environment=environment, results=image_details[0]["imageScanFindingsSummary"]["findingSeverityCounts"])
+def print_image_scan_findings(image_detail: dict, service:str, environment: str):
+  if "imageScanFindingsSummary" in image_detail:
+    if "findingSeverityCounts" in image_detail["imageScanFindingsSummary"]:
+      print(image_detail["imageScanFindingsSummary"]["findingSeverityCounts"])
+      push_results(service=service, environment=environment, results=image_detail["imageScanFindingsSummary"]["findingSeverityCounts"])
 
 def push_results(service: str, environment: str, results: dict):
-  registry = CollectorRegistry()
-  gauges = {}
-  for category in ["INFORMATIONAL", "LOW", "MEDIUM", "HIGH", "CRITICAL", "UNDEFINED"]:
-    gauges[category] = Gauge(("image_scan_result_" + category.lower()), ("The " + category.lower() + " vulnerabilities contained in an image"), ["instance"], registry=registry)
-    gauges[category].labels(instance=environment).set(get_result(category=category, results=results))
-  push_to_gateway(push_gateway_url, job=(service + "_" + environment), registry=registry, handler=push_gateway_handler)
-  
-  
+  gauges = []
+  for category in scan_categories:
+    gauges.append((("image_scan_result_" + category.lower()), ("The " + category.lower() + " vulnerabilities contained in an image"), {"instance": environment}, get_result(category=category, results=results)))
+  record_gauges(job=(service + "_" + environment), gauges=gauges)
+  if (push_immediately):
+    flush(jobs=[(service + "_" + environment)])
+
+# Scans the newest image of every repository in the account through a bounded
+# pool of workers and reports all of them in one JSON file and one push.
+def fleet_image_scan(environment: str, workers: int, report_path: str):
+  repositories = list_repositories(ecr=ecr_client(environment))
+  logging.info("Scanning the latest image of (" + str(len(repositories)) + ") repositories with (" + str(workers) + ") workers")
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    results = list(executor.map(lambda repository: scan_repository(environment=environment, repository=repository), repositories))
+
+  report = build_fleet_report(environment=environment, results=results)
+  with open(report_path, "w") as file:
+    json.dump(report, file, indent=2)
+  logging.info("Image scan report written to: " + report_path)
+  print(report["totals"])
+  push_fleet_results(environment=environment, results=results)
+
+  failed_scans = [result for result in results if result["status"] not in ["COMPLETE", "EMPTY"]]
+  if (len(failed_scans) > 0):
+    logging.error("Failed to scan (" + str(len(failed_scans)) + ") repositories: " + ", ".join(result["repository"] for result in failed_scans))
+    exit(1)
+
+def scan_repository(environment:str, repository:str) -> dict:
+  result = {"repository": repository, "imageDigest": None, "status": "ERROR", "findings": {}}
+  try:
+    ecr = ecr_client(environment)
+    image_detail = find_latest_image(ecr=ecr, service=repository)
+    if (image_detail is None):
+      result["status"] = "EMPTY"
+      return result
+    result["imageDigest"] = image_detail["imageDigest"]
+    if (parse_image_scan_status(image_detail=image_detail) not in ["COMPLETE", "IN_PROGRESS", "PENDING"]):
+      try:
+        ecr.start_image_scan(repositoryName=repository, imageId={"imageDigest": image_detail["imageDigest"]})
+      except ecr.exceptions.LimitExceededException:
+        logging.warning("[" + repository + "] Image was already scanned today, using the latest results")
+    image_detail = wait_for_image_scan(environment=environment, service=repository, image_digest=image_detail["imageDigest"], description=("image scan state of " + repository))
+    result["status"] = parse_image_scan_status(image_detail=image_detail)
+    result["findings"] = image_detail.get("imageScanFindingsSummary", {}).get("findingSeverityCounts", {})
+  except PollTimeout as error:
+    result["status"] = "TIMEOUT"
+    result["error"] = str(error)
+  except Exception as error:
+    result["error"] = str(error)
+  if (result["status"] != "COMPLETE"):
+    logging.error("[" + repository + "] Image scan status: (" + result["status"] + ")")
+  return result
+
+def build_fleet_report(environment: str, results: list) -> dict:
+  totals = {}
+  for category in scan_categories:
+    totals[category] = sum(get_result(category=category, results=result["findings"]) for result in results)
+  return {
+    "environment": environment,
+    "generatedAt": datetime.now(timezone.utc).isoformat(),
+    "totals": totals,
+    "repositories": results,
+  }
+
+def push_fleet_results(environment: str, results: list):
+  gauges = []
+  for category in scan_categories:
+    for result in results:
+      gauges.append((("image_scan_result_" + category.lower()), ("The " + category.lower() + " vulnerabilities contained in an image"), {"instance": environment, "repository": result["repository"]}, get_result(category=category, results=result["findings"])))
+  record_gauges(job=("image_scan_" + environment), gauges=gauges)
+  flush(jobs=[("image_scan_" + environment)])
+
 def get_result(category: str, results: dict) -> int:
   if (category in results):
     return results[category]
@@ -75,17 +166,32 @@ def get_result(category: str, results: dict) -> int:
     return 0
 
 
-def main():
+def main(argv: list = None):
   parser = argparse.ArgumentParser(description="AWS ECR Authentication Script")
 
-  parser.add_argument("--service", type=str, required=True, help="The name of the service we are interacting with")
+  parser.add_argument("--service", type=str, help="The name of the service we are interacting with")
   parser.add_argument("--environment", type=str, required=True, help="The name of the environment we are interacting with")
+  parser.add_argument("--timeout", default=1800, type=int, help="The number of seconds to wait for an image scan before giving up")
+  parser.add_argument("--push", action="store_true", help="Pushes the results straight away instead of leaving them in the metrics spool for the pipeline report")
+  parser.add_argument("--all-repositories", action="store_true", help="Scans the latest image of every repository in the account")
+  parser.add_argument("--workers", default=10, type=int, help="The number of repositories scanned at once when using --all-repositories")
+  parser.add_argument("--report", default="image_scan_report.json", type=str, help="The file the aggregated report is written to when using --all-repositories")
 
-  args = parser.parse_args()
+  args = parser.parse_args(argv)
 
   logging.getLogger().setLevel("INFO")
 
-  image_scan(service=args.service, environment=args.environment)
+  global scan_timeout, push_immediately
+  scan_timeout = args.timeout
+  push_immediately = args.push
+
+  if (args.all_repositories):
+    fleet_image_scan(environment=args.environment, workers=args.workers, report_path=args.report)
+  elif (args.service):
+    image_scan(service=args.service, environment=args.environment)
+  else:
+    print("Error: please use one of either --service or --all-repositories")
+    exit(1)
 
 if __name__ == "__main__":
   main()
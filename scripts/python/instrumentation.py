@@ -0,0 +1,131 @@
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Records the latency, retries and throttles of every AWS API call made through
+# the shared session, along with the wall time of each script phase. At exit
+# the records are appended to a job local JSON lines trace and added to the
+# metrics spool as histograms, to be pushed with the pipeline status.
+throttle_codes = ["Throttling", "ThrottlingException", "ThrottledException", "RequestThrottledException", "TooManyRequestsException", "RequestLimitExceeded", "SlowDown", "ProvisionedThroughputExceededException"]
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+phase_buckets = [0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1200, 2400]
+
+records = []
+records_lock = threading.Lock()
+installed = False
+
+def enabled() -> bool:
+  return os.environ.get("DEPLOYMENT_INSTRUMENTATION", "on").lower() not in ["off", "false", "0"]
+
+def script_name() -> str:
+  return os.path.splitext(os.path.basename(sys.argv[0]))[0] or "interactive"
+
+def add_record(record: dict):
+  record["script"] = script_name()
+  with records_lock:
+    records.append(record)
+
+def install(session):
+  global installed
+  if ((not enabled()) or installed):
+    return
+  session.events.register("before-call", before_call)
+  session.events.register("response-received", response_received)
+  session.events.register("after-call", after_call)
+  session.events.register("after-call-error", after_call_error)
+  atexit.register(export)
+  installed = True
+
+def before_call(model, context, **kwargs):
+  context["instrumentation"] = {"aws_service": model.service_model.service_name, "operation": model.name, "start": time.time(), "started": time.perf_counter(), "attempts": 0, "throttles": 0}
+
+def response_received(context, parsed_response=None, **kwargs):
+  if ("instrumentation" not in context):
+    return
+  context["instrumentation"]["attempts"] += 1
+  if ((parsed_response is not None) and (parsed_response.get("Error", {}).get("Code") in throttle_codes)):
+    context["instrumentation"]["throttles"] += 1
+
+def after_call(parsed, context, **kwargs):
+  record_call(context=context, error=parsed.get("Error", {}).get("Code"))
+
+def after_call_error(context, exception, **kwargs):
+  record_call(context=context, error=type(exception).__name__)
+
+def record_call(context: dict, error: str):
+  call = context.pop("instrumentation", None)
+  if (call is None):
+    return
+  add_record({
+    "type": "aws_call",
+    "aws_service": call["aws_service"],
+    "operation": call["operation"],
+    "start": call["start"],
+    "duration": time.perf_counter() - call["started"],
+    "retries": max(call["attempts"] - 1, 0),
+    "throttles": call["throttles"],
+    "error": error,
+  })
+
+def record_phase(name: str, duration: float, start: float = None):
+  add_record({"type": "phase", "phase": name, "start": start or (time.time() - duration), "duration": duration})
+
+@contextmanager
+def phase(name: str):
+  start = time.time()
+  started = time.perf_counter()
+  try:
+    yield
+  finally:
+    if enabled():
+      record_phase(name=name, duration=(time.perf_counter() - started), start=start)
+
+def trace_path() -> str:
+  from ttl_cache import default_cache_directory
+  return os.environ.get("DEPLOYMENT_TRACE_FILE", os.path.join(default_cache_directory(), "deployment-trace.jsonl"))
+
+def metrics_job() -> str:
+  if (("DEPLOY_SERVICE" in os.environ) and ("DEPLOY_ACCOUNT" in os.environ)):
+    return os.environ["DEPLOY_SERVICE"] + "_" + os.environ["DEPLOY_ACCOUNT"]
+  return "deployment_scripts"
+
+def export():
+  with records_lock:
+    exported_records = list(records)
+    records.clear()
+  if (len(exported_records) == 0):
+    return
+  try:
+    write_trace(exported_records)
+    spool_histograms(exported_records)
+  except Exception as error:
+    logging.warning("Unable to export instrumentation (" + str(error) + ")")
+
+def write_trace(exported_records: list):
+  os.makedirs(os.path.dirname(trace_path()), exist_ok=True)
+  with open(trace_path(), "a") as file:
+    for record in exported_records:
+      file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+def spool_histograms(exported_records: list):
+  from metrics_spool import record_histograms, record_counters
+  instance = os.environ.get("DEPLOY_ACCOUNT", "unknown")
+  histograms = []
+  counters = []
+  for record in exported_records:
+    if (record["type"] == "aws_call"):
+      labels = {"instance": instance, "script": record["script"], "aws_service": record["aws_service"], "operation": record["operation"]}
+      histograms.append(("deployment_aws_call_duration_seconds", "The latency of AWS API calls made by the deployment scripts", labels, latency_buckets, record["duration"]))
+      counters.append(("deployment_aws_call_retries", "The retries of AWS API calls made by the deployment scripts", labels, record["retries"]))
+      counters.append(("deployment_aws_call_throttles", "The throttled attempts of AWS API calls made by the deployment scripts", labels, record["throttles"]))
+      counters.append(("deployment_aws_call_errors", "The failed AWS API calls made by the deployment scripts", labels, (1 if record["error"] else 0)))
+    elif (record["type"] == "phase"):
+      labels = {"instance": instance, "script": record["script"], "phase": record["phase"]}
+      histograms.append(("deployment_phase_duration_seconds", "The wall time of each phase of the deployment scripts", labels, phase_buckets, record["duration"]))
+  record_histograms(job=metrics_job(), histograms=histograms)
+  record_counters(job=metrics_job(), counters=counters)
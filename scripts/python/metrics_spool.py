@@ -0,0 +1,173 @@
+from deployment_utilities import push_gateway_url, push_gateway_handler
+from ttl_cache import default_cache_directory
+import cassette
+import logging
+import argparse
+import bisect
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Metrics from every step of a job are collected in one job local file, grouped
+# by Pushgateway job. A flush pushes the complete state of each group, so
+# gauges written by different steps no longer replace each other.
+spool_lock = threading.Lock()
+
+def spool_path() -> str:
+  return os.environ.get("DEPLOYMENT_METRICS_SPOOL", os.path.join(default_cache_directory(), "metrics-spool.json"))
+
+def read_spool() -> dict:
+  if (not os.path.isfile(spool_path())):
+    return {}
+  try:
+    with open(spool_path(), "r") as file:
+      return json.load(file)
+  except (OSError, ValueError):
+    logging.warning("Unable to read the metrics spool, starting a new one")
+    return {}
+
+def write_spool(spool: dict):
+  os.makedirs(os.path.dirname(spool_path()), exist_ok=True)
+  descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(spool_path()))
+  with os.fdopen(descriptor, "w") as file:
+    json.dump(spool, file)
+  os.replace(temporary_path, spool_path())
+
+def record_gauge(job: str, name: str, documentation: str, labels: dict, value: float):
+  record_gauges(job=job, gauges=[(name, documentation, labels, value)])
+
+def record_gauges(job: str, gauges: list):
+  with spool_lock:
+    spool = read_spool()
+    for name, documentation, labels, value in gauges:
+      sample = spooled_sample(spool=spool, job=job, name=name, metric_type="gauge", documentation=documentation, labels=labels)
+      sample["value"] = value
+    write_spool(spool)
+
+# Counters and histograms accumulate across every step of the job, histogram
+# samples only keep their per bucket counts and sum.
+def record_counters(job: str, counters: list):
+  with spool_lock:
+    spool = read_spool()
+    for name, documentation, labels, value in counters:
+      sample = spooled_sample(spool=spool, job=job, name=name, metric_type="counter", documentation=documentation, labels=labels)
+      sample["value"] = sample.get("value", 0) + value
+    write_spool(spool)
+
+def record_histograms(job: str, histograms: list):
+  with spool_lock:
+    spool = read_spool()
+    for name, documentation, labels, buckets, value in histograms:
+      sample = spooled_sample(spool=spool, job=job, name=name, metric_type="histogram", documentation=documentation, labels=labels)
+      metric = spool[job][name]
+      metric.setdefault("buckets", buckets)
+      sample.setdefault("counts", [0] * (len(metric["buckets"]) + 1))
+      sample["counts"][bisect.bisect_left(metric["buckets"], value)] += 1
+      sample["sum"] = sample.get("sum", 0) + value
+    write_spool(spool)
+
+def spooled_sample(spool: dict, job: str, name: str, metric_type: str, documentation: str, labels: dict) -> dict:
+  metric = spool.setdefault(job, {}).setdefault(name, {"type": metric_type, "documentation": documentation, "labelnames": sorted(labels), "samples": []})
+  for sample in metric["samples"]:
+    if (sample["labels"] == labels):
+      return sample
+  sample = {"labels": labels}
+  metric["samples"].append(sample)
+  return sample
+
+class SpooledCollector:
+  def __init__(self, metrics: dict):
+    self.metrics = metrics
+
+  def collect(self):
+    from prometheus_client.core import CounterMetricFamily, HistogramMetricFamily
+    for name, metric in self.metrics.items():
+      if (metric["type"] == "counter"):
+        family = CounterMetricFamily(name, metric["documentation"], labels=metric["labelnames"])
+        for sample in metric["samples"]:
+          family.add_metric([sample["labels"][label] for label in metric["labelnames"]], sample["value"])
+        yield family
+      elif (metric["type"] == "histogram"):
+        family = HistogramMetricFamily(name, metric["documentation"], labels=metric["labelnames"])
+        for sample in metric["samples"]:
+          cumulative_counts = list(itertools.accumulate(sample["counts"]))
+          buckets = [(str(bound), count) for bound, count in zip(metric["buckets"] + ["+Inf"], cumulative_counts)]
+          family.add_metric([sample["labels"][label] for label in metric["labelnames"]], buckets, sample["sum"])
+        yield family
+
+# prometheus_client is only imported once something is pushed, recording to
+# the spool does not need it.
+def build_registry(metrics: dict):
+  from prometheus_client import Gauge, CollectorRegistry
+  registry = CollectorRegistry()
+  for name, metric in metrics.items():
+    if (metric.get("type", "gauge") != "gauge"):
+      continue
+    gauge = Gauge(name, metric["documentation"], metric["labelnames"], registry=registry)
+    for sample in metric["samples"]:
+      gauge.labels(**sample["labels"]).set(sample["value"])
+  registry.register(SpooledCollector({name: metric for name, metric in metrics.items() if metric.get("type", "gauge") != "gauge"}))
+  return registry
+
+def flush(retries: int = 3, timeout: float = 10, backoff: float = 2, jobs: list = None) -> bool:
+  if (cassette.replaying()):
+    logging.info("Not pushing metrics while replaying a cassette")
+    return True
+  with spool_lock:
+    spool = read_spool()
+  success = True
+  for job, metrics in spool.items():
+    if ((jobs is not None) and (job not in jobs)):
+      continue
+    from prometheus_client import push_to_gateway
+    registry = build_registry(metrics)
+    for attempt in range(retries + 1):
+      try:
+        push_to_gateway(push_gateway_url, job=job, registry=registry, timeout=timeout, handler=push_gateway_handler)
+        break
+      except Exception as error:
+        if (attempt == retries):
+          logging.error("Failed to push metrics for job: " + job + " (" + str(error) + ")")
+          success = False
+        else:
+          logging.warning("Failed to push metrics for job: " + job + ", retrying (" + str(error) + ")")
+          time.sleep(backoff * (2 ** attempt))
+  return success
+
+# Flushes from a detached process so the calling step does not wait on a slow
+# Pushgateway.
+def flush_in_background(retries: int = 3, timeout: float = 10):
+  environment = dict(os.environ)
+  environment["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__)) + os.pathsep + os.environ.get("PYTHONPATH", "")
+  subprocess.Popen(
+    [sys.executable, "-m", "metrics_spool", "--flush", "--retries", str(retries), "--timeout", str(timeout)],
+    env=environment,
+    stdout=subprocess.DEVNULL,
+    stderr=subprocess.DEVNULL,
+    start_new_session=(os.name != "nt"),
+  )
+
+def main(argv: list = None):
+  parser = argparse.ArgumentParser(description="Metrics Spool Script")
+
+  parser.add_argument("--flush", action="store_true", help="Pushes every spooled metric to the Pushgateway")
+  parser.add_argument("--retries", default=3, type=int, help="The number of times a failed push is retried")
+  parser.add_argument("--timeout", default=10, type=float, help="The number of seconds to wait for the Pushgateway")
+
+  args = parser.parse_args(argv)
+
+  logging.getLogger().setLevel("INFO")
+
+  if (args.flush):
+    if (not flush(retries=args.retries, timeout=args.timeout)):
+      exit(1)
+  else:
+    print(json.dumps(read_spool(), indent=2))
+
+if __name__ == "__main__":
+  main()
@@ -1,24 +1,20 @@
-from prometheus_client import Gauge, CollectorRegistry, push_to_gateway
-from deployment_utilities import *
+from metrics_spool import record_gauge, flush, flush_in_background
 import logging
 import argparse
 
-registry = CollectorRegistry()
-g = Gauge("pipeline_status", "The status of a pipeline", ["instance"], registry=registry)
+def report_status(service: str, environment: str, status: int):
+  record_gauge(job=(service + "_" + environment), name="pipeline_status", documentation="The status of a pipeline", labels={"instance": environment}, value=status)
 
 def success(service: str, environment: str):
-  g.labels(instance=environment).set(1)
-  push_to_gateway(push_gateway_url, job=(service + "_" + environment), registry=registry, handler=push_gateway_handler)
+  report_status(service=service, environment=environment, status=1)
 
 def failure(service: str, environment: str):
-  g.labels(instance=environment).set(0)
-  push_to_gateway(push_gateway_url, job=(service + "_" + environment), registry=registry, handler=push_gateway_handler)
+  report_status(service=service, environment=environment, status=0)
 
 def running(service: str, environment: str):
-  g.labels(instance=environment).set(2)
-  push_to_gateway(push_gateway_url, job=(service + "_" + environment), registry=registry, handler=push_gateway_handler)
+  report_status(service=service, environment=environment, status=2)
 
-def main():
+def main(argv: list = None):
   parser = argparse.ArgumentParser(description="Pipeline Reporting Script")
 
   parser.add_argument("--environment", type=str, required=True, help="The name of the environment we are interacting with")
@@ -26,8 +22,12 @@ def main():
   parser.add_argument("--success", action="store_true", help="Indicates a successfull pipeline run")
   parser.add_argument("--failure", action="store_true", help="Indicates a failing pipeline run")
   parser.add_argument("--running", action="store_true", help="Indicates a running pipeline")
+  parser.add_argument("--no-push", action="store_true", help="Only records the status in the metrics spool, a later step pushes it")
+  parser.add_argument("--background", action="store_true", help="Pushes the metrics spool without waiting for the Pushgateway")
+  parser.add_argument("--retries", default=3, type=int, help="The number of times a failed push is retried")
+  parser.add_argument("--timeout", default=10, type=float, help="The number of seconds to wait for the Pushgateway")
 
-  args = parser.parse_args()
+  args = parser.parse_args(argv)
 
   logging.getLogger().setLevel("INFO")
 
@@ -41,5 +41,12 @@ def main():
     print("Error: please use one of either --success or --failure or --running")
     exit(1)
 
+  if (args.no_push):
+    return
+  if (args.background):
+    flush_in_background(retries=args.retries, timeout=args.timeout)
+  elif (not flush(retries=args.retries, timeout=args.timeout)):
+    exit(1)
+
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  main()
@@ -0,0 +1,79 @@
+import instrumentation
+import logging
+import math
+import random
+import time
+
+class Clock:
+  def now(self) -> float:
+    return time.monotonic()
+
+  def sleep(self, seconds: float):
+    time.sleep(seconds)
+
+  # Wall clock time, for comparing with timestamps returned by AWS
+  def wall(self) -> float:
+    return time.time()
+
+  def uniform(self, low: float, high: float) -> float:
+    return random.uniform(low, high)
+
+clock = Clock()
+
+def set_clock(new_clock: Clock) -> Clock:
+  global clock
+  previous_clock = clock
+  clock = new_clock
+  return previous_clock
+
+class PollTimeout(Exception):
+  pass
+
+def format_elapsed(seconds: float) -> str:
+  seconds = int(seconds)
+  return str(math.floor(seconds / 60)) + "m" + str(seconds % 60) + "s"
+
+# Calls check until it returns something other than None, starting with short
+# intervals and backing off (with jitter) towards max_interval. A PollTimeout is
+# raised once the deadline has passed.
+def poll(check, description: str, timeout: float = 2400, initial_interval: float = 2, max_interval: float = 30, backoff: float = 1.5, jitter: float = 0.2, phase: str = "poll"):
+  with instrumentation.phase(phase):
+    return poll_until_done(check=check, description=description, timeout=timeout, initial_interval=initial_interval, max_interval=max_interval, backoff=backoff, jitter=jitter)
+
+def poll_until_done(check, description: str, timeout: float, initial_interval: float, max_interval: float, backoff: float, jitter: float):
+  start = clock.now()
+  interval = initial_interval
+  while True:
+    result = check()
+    if (result is not None):
+      return result
+    elapsed = clock.now() - start
+    if (elapsed >= timeout):
+      raise PollTimeout("Timed out after " + format_elapsed(elapsed) + " waiting for " + description)
+    logging.info("Polling " + description + " [" + format_elapsed(elapsed) + "]")
+    delay = interval * clock.uniform(1 - jitter, 1 + jitter)
+    clock.sleep(max(0, min(delay, timeout - elapsed)))
+    interval = min(interval * backoff, max_interval)
+
+# Keeps track of the newest item seen in a newest first stream (such as ECS
+# service events) so that each poll only has to look at what is new. The first
+# call primes the cursor and ignores history.
+class EventCursor:
+  def __init__(self, id_key: str = "id"):
+    self.id_key = id_key
+    self.last_seen_id = None
+    self.primed = False
+
+  def new_events(self, events: list) -> list:
+    new_events = []
+    for event in events:
+      if (event[self.id_key] == self.last_seen_id):
+        break
+      new_events.append(event)
+    if (len(events) > 0):
+      self.last_seen_id = events[0][self.id_key]
+    if (not self.primed):
+      self.primed = True
+      return []
+    new_events.reverse()
+    return new_events
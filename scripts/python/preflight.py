@@ -0,0 +1,98 @@
+from metrics_spool import flush
+import pipeline_reporting
+import versioning
+import ecr_authenticate
+import instrumentation
+import logging
+import argparse
+import threading
+import time
+
+# The steps a deployment needs before terraform init. They do not depend on
+# each other, so they run at the same time and share the assumed roles, the
+# secret and the AWS clients through the caches in deployment_utilities. Each
+# task runs in a daemon thread so that one which overruns its timeout can be
+# abandoned instead of holding up the job.
+class PreflightTask:
+  def __init__(self, name: str, function, timeout: float):
+    self.name = name
+    self.function = function
+    self.timeout = timeout
+    self.error = None
+    self.timed_out = False
+    self.duration = None
+    self.finished = threading.Event()
+    self.thread = threading.Thread(target=self.run, name=("preflight-" + name), daemon=True)
+
+  def run(self):
+    started = time.time()
+    try:
+      with instrumentation.phase("preflight-" + self.name):
+        self.function()
+    except SystemExit as error:
+      if (error.code not in [None, 0]):
+        self.error = "exited with status (" + str(error.code) + ")"
+    except Exception as error:
+      self.error = type(error).__name__ + ": " + str(error)
+    finally:
+      self.duration = time.time() - started
+      self.finished.set()
+
+  # An abandoned task keeps running, so the timeout is kept apart from the
+  # error its thread may still set.
+  def wait(self, deadline: float):
+    if (not self.finished.wait(timeout=max(0, deadline - time.time()))):
+      self.timed_out = True
+
+  def failure(self) -> str:
+    if (self.timed_out):
+      return "timed out after " + str(self.timeout) + " seconds"
+    return self.error
+
+def report_running(service: str, environment: str, retries: int, timeout: float):
+  pipeline_reporting.running(service=service, environment=environment)
+  if (not flush(retries=retries, timeout=timeout, jobs=[(service + "_" + environment)])):
+    raise RuntimeError("Failed to push the running pipeline status")
+
+def preflight(tasks: list) -> int:
+  started = time.time()
+  for task in tasks:
+    task.thread.start()
+  for task in tasks:
+    task.wait(deadline=(started + task.timeout))
+
+  failed_tasks = [task for task in tasks if task.failure() is not None]
+  for task in tasks:
+    if (task not in failed_tasks):
+      logging.info("Preflight task " + task.name + " finished in " + str(round(task.duration, 1)) + " seconds")
+  for task in failed_tasks:
+    logging.error("Preflight task " + task.name + " failed: " + task.failure())
+  logging.info("Preflight finished in " + str(round(time.time() - started, 1)) + " seconds")
+  return 1 if (len(failed_tasks) > 0) else 0
+
+def main(argv: list = None):
+  parser = argparse.ArgumentParser(description="Deployment Preflight Script")
+
+  parser.add_argument("--service", type=str, required=True, help="The name of the service we are deploying")
+  parser.add_argument("--environment", type=str, required=True, help="The name of the environment we are deploying to")
+  parser.add_argument("--skip-version", action="store_true", help="Does not fetch the version of the service, for deployments without one")
+  parser.add_argument("--directory", nargs='?', default="./", type=str, help="The directory package.json is written to")
+  parser.add_argument("--tfvars", default="terraform.tfvars", type=str, help="The tfvars file the ECR token is merged into")
+  parser.add_argument("--timeout", default=120, type=int, help="The number of seconds each task may take before the preflight gives up on it")
+  parser.add_argument("--retries", default=3, type=int, help="The number of times a failed push of the running status is retried")
+
+  args = parser.parse_args(argv)
+
+  logging.getLogger().setLevel("INFO")
+
+  tasks = [
+    PreflightTask("report-running", lambda: report_running(service=args.service, environment=args.environment, retries=args.retries, timeout=10), timeout=args.timeout),
+    PreflightTask("ecr-auth", lambda: ecr_authenticate.create_tfvars(environments=[args.environment], path=args.tfvars), timeout=args.timeout),
+  ]
+  if (not args.skip_version):
+    tasks.append(PreflightTask("fetch-version", lambda: versioning.fetch(services=[args.service], directory=args.directory), timeout=args.timeout))
+
+  exit(preflight(tasks))
+
+if __name__ == "__main__":
+  main()
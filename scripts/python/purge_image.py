@@ -1,55 +1,149 @@
-import boto3
 from deployment_utilities import *
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import logging
 import argparse
+import fnmatch
+import heapq
 import time
 
-def main():
-  parser = argparse.ArgumentParser(description="AWS ECR Purge Old Images Script")
-
-  parser.add_argument("--service", type=str, required=True, help="The name of the service we are stopping")
-  parser.add_argument("--environment", type=str, required=True, help="The name of the environment we are stopping")
-
-  args = parser.parse_args()
-
-  logging.getLogger().setLevel("INFO")
-
-  credentials = switch_role(account=args.environment, session_name="PurgeImageSession")
-  ecr = get_aws_client("ecr", credentials)
-
-  logging.info("Purging images for: " + args.service)
-  images = ecr.list_images(repositoryName=args.service, maxResults=1000)
-  descriptions = ecr.describe_images(repositoryName=args.service, imageIds=images["imageIds"])["imageDetails"]
-  descriptions.sort(key=extract_time, reverse=True)
-
-  if (len(descriptions) <= 5):
-    logging.info("No images need to be deleted")
-    exit(0)
-  
-  old_image_descriptions = descriptions[5:]
+# ECR accepts at most 100 image ids per batch_delete_image call
+batch_size = 100
+
+class RetentionPolicy:
+  def __init__(self, keep: int = 5, max_age_days: int = None, keep_tags: list = None):
+    self.keep = keep
+    self.max_age_days = max_age_days
+    self.keep_tags = keep_tags or []
+    self.now = datetime.now(timezone.utc)
+
+  # Images outside of the newest `keep` are still retained when one of their
+  # tags matches a protected pattern or when they are younger than the max age.
+  def protected(self, pushed_at: datetime, tags: list) -> bool:
+    for tag in tags:
+      for pattern in self.keep_tags:
+        if fnmatch.fnmatch(tag, pattern):
+          return True
+    if (self.max_age_days is not None):
+      if (pushed_at > (self.now - timedelta(days=self.max_age_days))):
+        return True
+    return False
+
+# A repository that cannot be purged is recorded in its summary instead of
+# stopping the other workers, like scan_repository in image_scan.
+def purge_repository(ecr, repository: str, policy: RetentionPolicy, dry_run: bool) -> dict:
+  summary = {"repository": repository, "scanned": 0, "deleted": 0, "failed": 0, "bytes": 0, "error": None}
+  try:
+    delete_old_images(ecr=ecr, repository=repository, policy=policy, dry_run=dry_run, summary=summary)
+  except Exception as error:
+    summary["error"] = str(error)
+    logging.error("[" + repository + "] Unable to purge repository: " + summary["error"])
+  return summary
+
+def delete_old_images(ecr, repository: str, policy: RetentionPolicy, dry_run: bool, summary: dict):
+  candidates = find_purge_candidates(ecr=ecr, repository=repository, policy=policy, summary=summary)
+  if (len(candidates) == 0):
+    logging.info("[" + repository + "] No images need to be deleted")
+    return
+
+  for i in range(0, len(candidates), batch_size):
+    chunk = candidates[i:(i + batch_size)]
+    if (dry_run):
+      summary["deleted"] += len(chunk)
+      summary["bytes"] += sum(size for digest, size in chunk)
+      continue
+    response = ecr.batch_delete_image(repositoryName=repository, imageIds=[{"imageDigest": digest} for digest, size in chunk])
+    failed_digests = set(failure.get("imageId", {}).get("imageDigest") for failure in response["failures"])
+    for digest, size in chunk:
+      if (digest in failed_digests):
+        summary["failed"] += 1
+      else:
+        summary["deleted"] += 1
+        summary["bytes"] += size
+
+  if (summary["failed"] > 0):
+    logging.error("[" + repository + "] Failed to delete (" + str(summary["failed"]) + ") images")
+  logging.info("[" + repository + "] " + ("Would delete" if dry_run else "Deleted") + " (" + str(summary["deleted"]) + ") old images, reclaiming " + format_bytes(summary["bytes"]))
+
+# Streams every page of the repository through a heap holding the newest
+# `keep` images. Anything pushed out of the heap is older than all of them, so
+# only compact (digest, size) records of deletable images are kept. Deletion
+# happens once listing has finished so that pagination is not disturbed.
+def find_purge_candidates(ecr, repository: str, policy: RetentionPolicy, summary: dict) -> list:
+  newest = []
+  candidates = []
+  paginator = ecr.get_paginator("describe_images")
+  for page in paginator.paginate(repositoryName=repository, PaginationConfig={"PageSize": 1000}):
+    for description in page["imageDetails"]:
+      summary["scanned"] += 1
+      image = (extract_time(description), description["imageDigest"], description.get("imageSizeInBytes", 0), description.get("imageTags", []))
+      heapq.heappush(newest, image)
+      if (len(newest) > policy.keep):
+        pushed_at, digest, size, tags = heapq.heappop(newest)
+        if (not policy.protected(pushed_at=pushed_at, tags=tags)):
+          candidates.append((digest, size))
+  return candidates
 
-  image_ids = []
+def extract_time(descriptions):
+  try:
+    return descriptions["imagePushedAt"]
+  except KeyError:
+    return datetime.fromtimestamp(0, timezone.utc)
 
-  for description in old_image_descriptions:
-    image_id = {}
-    image_id["imageDigest"] = description["imageDigest"]
-    image_id["imageTag"] = description["imageTags"][0]
-    image_ids.append(image_id)
+# Fetched for every repository, so that a long sweep picks up renewed assumed
+# role credentials before the ones shared by an earlier step expire.
+def ecr_client(environment: str):
+  return get_account_client("ecr", account=environment, session_name="PurgeImageSession")
 
-  response = ecr.batch_delete_image(repositoryName=args.service, imageIds=image_ids)
+def format_bytes(size: int) -> str:
+  for unit in ["B", "KiB", "MiB", "GiB"]:
+    if (size < 1024):
+      return str(round(size, 1)) + unit
+    size = size / 1024
+  return str(round(size, 1)) + "TiB"
 
-  if (len(response["failures"]) > 0):
-    logging.error("Failed to delete (" + str(len(response["failures"])) + ") images")
+def main(argv: list = None):
+  parser = argparse.ArgumentParser(description="AWS ECR Purge Old Images Script")
 
-  logging.info("Deleted (" + str(len(old_image_descriptions)) + ") old images")
+  parser.add_argument("--service", type=str, nargs='+', help="The names of the repositories we are purging")
+  parser.add_argument("--environment", type=str, required=True, help="The name of the environment we are stopping")
+  parser.add_argument("--all-repositories", action="store_true", help="Purges every repository in the account")
+  parser.add_argument("--keep", default=5, type=int, help="The number of most recent images to keep")
+  parser.add_argument("--max-age-days", default=None, type=int, help="Images younger than this number of days are kept")
+  parser.add_argument("--keep-tag", action="append", default=[], help="A tag pattern (e.g. release-*) marking images to keep, may be repeated")
+  parser.add_argument("--dry-run", action="store_true", help="Reports what would be deleted without deleting anything")
+  parser.add_argument("--workers", default=5, type=int, help="The number of repositories purged at once")
 
+  args = parser.parse_args(argv)
 
-def extract_time(descriptions):
-  try:
-    return descriptions["imagePushedAt"]
-  except KeyError:
-    return 0
+  logging.getLogger().setLevel("INFO")
 
+  if (args.all_repositories):
+    repositories = list_repositories(ecr=ecr_client(args.environment))
+  elif (args.service):
+    repositories = args.service
+  else:
+    print("Error: please use one of either --service or --all-repositories")
+    exit(1)
+
+  policy = RetentionPolicy(keep=args.keep, max_age_days=args.max_age_days, keep_tags=args.keep_tag)
+  for repository in repositories:
+    logging.info("Purging images for: " + repository)
+  with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    summaries = list(executor.map(lambda repository: purge_repository(ecr=ecr_client(args.environment), repository=repository, policy=policy, dry_run=args.dry_run), repositories))
+
+  if (len(summaries) > 1):
+    logging.info("Scanned (" + str(sum(summary["scanned"] for summary in summaries)) + ") images across (" + str(len(summaries)) + ") repositories")
+    logging.info(("Would delete" if args.dry_run else "Deleted") + " (" + str(sum(summary["deleted"] for summary in summaries)) + ") old images, reclaiming " + format_bytes(sum(summary["bytes"] for summary in summaries)))
+
+  failed_repositories = [summary["repository"] for summary in summaries if summary["error"] is not None]
+  failed_images = sum(summary["failed"] for summary in summaries)
+  if (len(failed_repositories) > 0):
+    logging.error("Failed to purge (" + str(len(failed_repositories)) + ") repositories: " + ", ".join(failed_repositories))
+  if (failed_images > 0):
+    logging.error("Failed to delete (" + str(failed_images) + ") images")
+  if ((len(failed_repositories) > 0) or (failed_images > 0)):
+    exit(1)
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  main()
@@ -1,29 +1,80 @@
-import boto3
 from deployment_utilities import *
+from polling import poll, PollTimeout, format_elapsed
+from concurrent.futures import ThreadPoolExecutor
+import polling
 import logging
 import argparse
-import time
 
-def main():
+drain_timeout = 600
+
+# Scales every service down at once and then waits for all of them to drain
+# with a single batched describe_services poll, so stopping many services takes
+# about as long as the slowest one. The client is fetched again on every poll so
+# that credentials shared by an earlier step are renewed during a long drain.
+def stop_services(targets: list, environment: str, workers: int) -> int:
+  ecs = get_account_client("ecs", account=environment, session_name="StopServiceSession")
+  started = polling.clock.now()
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    results = list(executor.map(lambda target: scale_down(ecs=ecs, cluster=target[0], service=target[1]), targets))
+  draining = [target for target, stopped in zip(targets, results) if stopped]
+  exit_code = 0 if (len(draining) == len(targets)) else 1
+
+  drain_durations = {}
+  def check_drained():
+    ecs = get_account_client("ecs", account=environment, session_name="StopServiceSession")
+    clusters = group_by_cluster([target for target in draining if target not in drain_durations])
+    for cluster, services in clusters.items():
+      described_services = describe_services_batched(ecs, cluster=cluster, services=services)
+      for service in services:
+        described_service = described_services.get(service)
+        if ((described_service is None) or ((described_service["runningCount"] == 0) and (described_service["pendingCount"] == 0))):
+          drain_durations[(cluster, service)] = polling.clock.now() - started
+          logging.info("Service drained: " + cluster + "/" + service + " [" + format_elapsed(drain_durations[(cluster, service)]) + "]")
+    if (len(drain_durations) == len(draining)):
+      return True
+    return None
+
+  if (len(draining) > 0):
+    try:
+      poll(check_drained, "services draining", timeout=drain_timeout, initial_interval=2, max_interval=15, phase="poll-drain")
+    except PollTimeout as error:
+      logging.error(str(error))
+      for cluster, service in draining:
+        if ((cluster, service) not in drain_durations):
+          logging.error("Service did not drain in time: " + cluster + "/" + service)
+      exit_code = 1
+
+  if (len(drain_durations) > 0):
+    logging.info("Stopped (" + str(len(drain_durations)) + ") services in " + format_elapsed(max(drain_durations.values())))
+  return exit_code
+
+def scale_down(ecs, cluster: str, service: str) -> bool:
+  logging.info("Stopping service: " + cluster + "/" + service)
+  try:
+    ecs.update_service(cluster=cluster, service=service, desiredCount=0)
+    return True
+  except (ecs.exceptions.ServiceNotFoundException, ecs.exceptions.ServiceNotActiveException, ecs.exceptions.ClusterNotFoundException) as error:
+    logging.error("Unable to stop service: " + cluster + "/" + service + " (" + error.response["Error"]["Code"] + ")")
+    return False
+
+def main(argv: list = None):
   parser = argparse.ArgumentParser(description="AWS ECS Stop Service Script")
 
-  parser.add_argument("--service", type=str, required=True, help="The name of the service we are stopping")
+  parser.add_argument("--service", type=str, nargs='+', required=True, help="The names of the services we are stopping, optionally as cluster/service")
   parser.add_argument("--environment", type=str, required=True, help="The name of the environment we are stopping")
-  parser.add_argument("--cluster", nargs='?', default="core-services", type=str, help="The name of the environment we are stopping")
+  parser.add_argument("--cluster", nargs='?', default="core-services", type=str, help="The name of the cluster used for services given without one")
+  parser.add_argument("--timeout", default=600, type=int, help="The number of seconds to wait for the services to drain before giving up")
+  parser.add_argument("--workers", default=10, type=int, help="The number of services scaled down at once")
 
-  args = parser.parse_args()
+  args = parser.parse_args(argv)
 
   logging.getLogger().setLevel("INFO")
 
-  credentials = switch_role(account=args.environment, session_name="StopServiceSession")
-  ecs = get_aws_client("ecs", credentials)
-
-  logging.info("Stopping service: " + args.service)
-  ecs.update_service(cluster=args.cluster, service=args.service, desiredCount=0)
-
-  logging.info("Service successfully stopped, sleeping for 60 seconds...")
+  global drain_timeout
+  drain_timeout = args.timeout
 
-  time.sleep(60)  
+  targets = parse_service_targets(args.service, default_cluster=args.cluster)
+  exit(stop_services(targets=targets, environment=args.environment, workers=args.workers))
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  main()
@@ -0,0 +1,75 @@
+from collections import Counter
+from deployment_utilities import list_stopped_tasks, describe_tasks_batched
+
+# Works out why the tasks of a deployment stopped, so that a crash looping
+# deployment can be reverted after a few failed tasks instead of waiting for
+# ECS to increment failedTasks or mark the rollout as FAILED.
+image_pull_errors = ["CannotPullContainerError", "CannotPullImageManifestError", "PullImageManifestError", "CannotInspectContainerError"]
+health_check_messages = ["failed ELB health checks", "failed container health checks"]
+# Stops initiated by the scheduler or a user are expected during a rollout
+expected_stop_codes = ["ServiceSchedulerInitiated", "UserInitiated", "SpotInterruption", "TerminationNotice"]
+
+def classify_stopped_task(task: dict) -> str:
+  reason = task.get("stoppedReason", "")
+  if any(error in reason for error in image_pull_errors):
+    return "image-pull"
+  if any(message in reason for message in health_check_messages):
+    return "health-check"
+  if (task.get("stopCode") in expected_stop_codes):
+    return None
+  for container in task.get("containers", []):
+    if (container.get("exitCode") not in [None, 0]):
+      return "exit-code"
+  if (task.get("stopCode") == "TaskFailedToStart"):
+    return "startup"
+  if (task.get("stopCode") == "EssentialContainerExited"):
+    return "exit-code"
+  return None
+
+def describe_failure(task: dict) -> str:
+  exit_codes = [container["name"] + "=" + str(container["exitCode"]) for container in task.get("containers", []) if container.get("exitCode") not in [None, 0]]
+  description = task["taskArn"].split("/")[-1] + ": " + task.get("stoppedReason", "no reason given")
+  if (len(exit_codes) > 0):
+    description += " (exit codes " + ", ".join(exit_codes) + ")"
+  return description
+
+# Counts the failed tasks of one deployment against a budget
+class FailureBudget:
+  def __init__(self, budget: int):
+    self.budget = budget
+    self.failures = Counter()
+
+  def record(self, task: dict) -> str:
+    category = classify_stopped_task(task)
+    if (category is not None):
+      self.failures[category] += 1
+    return category
+
+  def exhausted(self) -> bool:
+    return ((self.budget > 0) and (sum(self.failures.values()) >= self.budget))
+
+  def summary(self) -> str:
+    return ", ".join(category + "(" + str(count) + ")" for category, count in sorted(self.failures.items()))
+
+# Finds the tasks that stopped since the last check for a set of deployments,
+# at most once per interval and cluster. Stopped tasks are listed per service,
+# only new ones are described (in batches of 100 per cluster) and only those
+# started by the given deployments are returned.
+class StoppedTaskWatcher:
+  def __init__(self, interval: float):
+    self.interval = interval
+    self.last_checks = {}
+    self.seen_tasks = set()
+
+  def new_stopped_tasks(self, ecs, cluster: str, deployments: dict, now: float) -> list:
+    if ((cluster in self.last_checks) and ((now - self.last_checks[cluster]) < self.interval)):
+      return []
+    self.last_checks[cluster] = now
+    task_arns = []
+    for service in deployments:
+      task_arns.extend(task_arn for task_arn in list_stopped_tasks(ecs, cluster=cluster, service=service) if task_arn not in self.seen_tasks)
+    self.seen_tasks.update(task_arns)
+    if (len(task_arns) == 0):
+      return []
+    deployment_ids = list(deployments.values())
+    return [task for task in describe_tasks_batched(ecs, cluster=cluster, task_arns=task_arns) if task.get("startedBy") in deployment_ids]
@@ -1,149 +1,279 @@
-import boto3
 from deployment_utilities import *
+from polling import poll, PollTimeout, EventCursor
+from deployment_snapshot import ServiceSnapshot, format_changes
+from deployment_timeline import DeploymentTimeline
+from metrics_spool import record_gauges
+from task_failures import FailureBudget, StoppedTaskWatcher, describe_failure
+import instrumentation
+import polling
 from datetime import datetime, timedelta
 import logging
 import argparse
 import json
 import time
-import math
-
-cluster = ""
-
-def track_rollout(deployment_id: str, environment: str, service: str) -> bool:
-  logging.info("Starting the tracking of service rollout")
-  credentials = switch_role(account=environment, session_name="TrackDeploymentSession")
-  ecs = get_aws_client("ecs", credentials)
-  deployments = ecs.describe_services(cluster=cluster, services=[service])["services"][0]["deployments"]
-  rollout_state = parse_deployment_state(deployments=deployments, deployment_id=deployment_id)
-  running_count = parse_running_count(deployments=deployments, deployment_id=deployment_id)
-  pending_count = parse_pending_count(deployments=deployments, deployment_id=deployment_id)
-  failed_tasks = parse_failed_tasks(deployments=deployments, deployment_id=deployment_id)
-  i = 0
-  while ((rollout_state != "COMPLETED") or (running_count == 0) or (pending_count > 0)):
-    logging.info("Polling service rollout state [" + str(math.floor((i*30)/60)) + "m" + str((i*30)%60) + "s]")
-    logging.info("rollout_state(" + rollout_state + ") running_count(" + str(running_count) + ") pending_count(" + str(pending_count) + ") failed_tasks(" + str(failed_tasks) + ")")
-    time.sleep(30)
-    deployments = ecs.describe_services(cluster=cluster, services=[service])["services"][0]["deployments"]
-    running_count = parse_running_count(deployments=deployments, deployment_id=deployment_id)
-    rollout_state = parse_deployment_state(deployments=deployments, deployment_id=deployment_id)
-    pending_count = parse_pending_count(deployments=deployments, deployment_id=deployment_id)
-    if (rollout_state == "FAILED"):
-      logging.error("Rollout failed, if possible a revert to the last healthy deployment will be attempted")
+
+rollout_timeout = 2400
+failure_budget = 3
+stopped_task_interval = 30
+steady_state_message = "has reached a steady state"
+
+# Tracks the rollout of a single service, and the revert to its last healthy
+# task definition if the rollout fails. Many trackers are advanced together by
+# track_rollouts so that their services can be described in batches.
+class RolloutTracker:
+  def __init__(self, cluster: str, service: str, environment: str, prefix: str = ""):
+    self.cluster = cluster
+    self.service = service
+    self.environment = environment
+    self.prefix = prefix
+    self.deployment_id = None
+    self.healthy_task_definition = None
+    self.reverting = False
+    self.revert_started = None
+    self.exit_code = None
+    self.event_cursor = EventCursor()
+    self.previous_snapshot = None
+    self.failure_budget = FailureBudget(failure_budget)
+    self.timeline = None
+
+  def log(self, level: int, message: str):
+    logging.log(level, self.prefix + message)
+
+  def done(self) -> bool:
+    return (self.exit_code is not None)
+
+  def watching_tasks(self) -> bool:
+    return ((not self.done()) and (not self.reverting) and (self.deployment_id is not None) and (self.failure_budget.budget > 0))
+
+  def finish(self, exit_code: int):
+    self.exit_code = exit_code
+    if (self.timeline is not None):
+      self.timeline.finish(exit_code, polling.clock.wall())
+    if (self.reverting):
+      instrumentation.record_phase("revert", duration=(time.time() - self.revert_started), start=self.revert_started)
+
+  def start(self, ecs, snapshot: ServiceSnapshot):
+    edge_case = check_edge_cases(snapshot=snapshot, environment=self.environment, service=self.service)
+    if (edge_case is not None):
+      self.finish(edge_case)
+      return
+
+    if (snapshot.oldest().rollout_state == "COMPLETED"):
+      self.healthy_task_definition = snapshot.oldest().task_definition
+    else:
+      self.log(logging.WARNING, "No healthy rollout state to revert to in case of failure")
+
+    if (self.environment != "production"):
+      if (snapshot.newest().desired_count == 0):
+        if (snapshot.oldest().desired_count == 0):
+          self.log(logging.WARNING, "Service is currently scaled down, will try to scale the most recent deployment up")
+          snapshot = ServiceSnapshot(ecs.update_service(cluster=self.cluster, service=self.service, desiredCount=1)["service"], cluster=self.cluster)
+
+    self.deployment_id = snapshot.newest().id
+    self.timeline = DeploymentTimeline(cluster=self.cluster, service=self.service, environment=self.environment, deployment_id=self.deployment_id, task_definition=snapshot.newest().task_definition, started=created_at(snapshot.newest()))
+    self.timeline.observe(snapshot.newest(), polling.clock.wall())
+    self.log(logging.INFO, "Starting the tracking of service rollout")
+
+  def update(self, ecs, snapshot: ServiceSnapshot):
+    if (snapshot.deployment(self.deployment_id) is None):
+      self.log(logging.ERROR, "Deployment (" + self.deployment_id + ") is no longer part of the service, it has likely been replaced by another deployment")
+      self.finish(1)
+      return
+    if (not self.reverting):
+      self.timeline.observe(snapshot.deployment(self.deployment_id), polling.clock.wall())
+    rollout = self.check_rollout(snapshot=snapshot)
+    if (rollout is None):
+      return
+    if (self.reverting):
+      self.timeline.mark("revert_finished", polling.clock.wall())
+      if (rollout):
+        self.log(logging.WARNING, "Revert completed successfully")
+      else:
+        self.log(logging.ERROR, "Revert failed, please contact administrator")
+      self.finish(1)
+    elif (rollout):
+      self.log(logging.INFO, "Rollout completed successfully")
+      self.timeline.mark("steady_state", polling.clock.wall())
+      self.finish(0)
+    else:
+      self.revert_rollout(ecs)
+
+  def check_rollout(self, snapshot: ServiceSnapshot):
+    deployment = snapshot.deployment(self.deployment_id)
+    changes = snapshot.diff(self.previous_snapshot, self.deployment_id)
+    self.previous_snapshot = snapshot
+    if (len(changes) > 0):
+      self.log(logging.INFO, format_changes(changes))
+    new_events = self.event_cursor.new_events(snapshot.events)
+    for event in new_events:
+      self.log(logging.INFO, "Service event: " + event["message"])
+    if (deployment.rollout_state == "FAILED"):
+      self.log(logging.ERROR, "Rollout failed, if possible a revert to the last healthy deployment will be attempted")
       return False
-    failed_tasks = parse_failed_tasks(deployments=deployments, deployment_id=deployment_id)
-    if (failed_tasks > 0):
-      logging.error("Rollout failed due to a failed task, if possible a revert to the last healthy deployment will be attempted")
+    if (deployment.failed_tasks > 0):
+      self.log(logging.ERROR, "Rollout failed due to a failed task, if possible a revert to the last healthy deployment will be attempted")
       return False
-    if (i > 80):
-      logging.error("Timed out waiting for rollout")
-      exit(1)
-    i = i + 1
-  logging.info("Rollout completed successfully")
-  return True
-
-def revert_rollout(task_definition: str, environment: str, service: str):
-  logging.warning("Reverting rollout to last healthy task definition")
-  credentials = switch_role(account=environment, session_name="TrackDeploymentSession")
-  ecs = get_aws_client("ecs", credentials)
-  deployments = sort_deployments(ecs.update_service(cluster=cluster, service=service, taskDefinition=task_definition)["service"]["deployments"])
-  deployment_id = deployments[0]["id"]
-  if (track_rollout(deployment_id=deployment_id, environment=environment, service=service)):
-    logging.warning("Revert completed successfully")
-    exit(1)
-  else:
-    logging.error("Revert failed, please contact administrator")
-    exit(1)
-
-
-def sort_deployments(deployments: dict) -> dict:
-  deployments.sort(key = lambda x:x["createdAt"], reverse=True)
-  return deployments
-
-def check_edge_cases(deployments: dict, environment: str, service: str) -> dict:
+    if ((deployment.running_count == 0) or (deployment.pending_count > 0)):
+      return None
+    if (deployment.rollout_state == "COMPLETED"):
+      return True
+    if ((len(snapshot.deployments) == 1) and parse_service_state(events=new_events, success=steady_state_message)):
+      self.log(logging.INFO, "Service reported a steady state before the rollout state was updated")
+      return True
+    return None
+
+  def revert_rollout(self, ecs):
+    if (self.healthy_task_definition is None):
+      self.log(logging.ERROR, "No past healthy deployment to revert to")
+      self.finish(1)
+      return
+    self.log(logging.WARNING, "Reverting rollout to last healthy task definition")
+    snapshot = ServiceSnapshot(ecs.update_service(cluster=self.cluster, service=self.service, taskDefinition=self.healthy_task_definition)["service"], cluster=self.cluster)
+    self.deployment_id = snapshot.newest().id
+    self.previous_snapshot = None
+    self.reverting = True
+    self.revert_started = time.time()
+    self.timeline.mark("revert_started", created_at(snapshot.newest()))
+
+# When a deployment was created, as a wall clock timestamp, falling back to the
+# current time if ECS did not say or the clocks disagree.
+def created_at(deployment) -> float:
+  now = polling.clock.wall()
+  if ((deployment.created_at is None) or (deployment.created_at.tzinfo is None)):
+    return now
+  return min(deployment.created_at.timestamp(), now)
+
+def describe_trackers(ecs, trackers: list) -> list:
+  described = []
+  clusters = group_by_cluster([(tracker.cluster, tracker.service) for tracker in trackers])
+  for cluster, services in clusters.items():
+    described_services = describe_services_batched(ecs, cluster=cluster, services=services)
+    for tracker in trackers:
+      if (tracker.cluster != cluster):
+        continue
+      if (tracker.service not in described_services):
+        tracker.log(logging.ERROR, "Service could not be found in cluster: " + cluster)
+        tracker.finish(1)
+      else:
+        described.append((tracker, ServiceSnapshot(described_services[tracker.service], cluster=cluster)))
+  return described
+
+# Counts the tasks each rollout has stopped since the last check against its
+# failure budget, a rollout that uses up its budget is reverted straight away.
+def check_stopped_tasks(ecs, watcher: StoppedTaskWatcher, trackers: list):
+  clusters = {}
+  for tracker in trackers:
+    clusters.setdefault(tracker.cluster, []).append(tracker)
+  for cluster, cluster_trackers in clusters.items():
+    deployments = {tracker.deployment_id: tracker for tracker in cluster_trackers}
+    for task in watcher.new_stopped_tasks(ecs, cluster=cluster, deployments={tracker.service: tracker.deployment_id for tracker in cluster_trackers}, now=polling.clock.now()):
+      tracker = deployments[task["startedBy"]]
+      category = tracker.failure_budget.record(task)
+      if (category is not None):
+        tracker.log(logging.WARNING, "Task failed (" + category + "): " + describe_failure(task))
+    for tracker in cluster_trackers:
+      if (tracker.failure_budget.exhausted()):
+        tracker.log(logging.ERROR, "Rollout failed, stopped tasks used up the failure budget: " + tracker.failure_budget.summary() + ", if possible a revert to the last healthy deployment will be attempted")
+        tracker.revert_rollout(ecs)
+
+def track_rollouts(trackers: list, environment: str) -> int:
+  watcher = StoppedTaskWatcher(interval=stopped_task_interval)
+
+  def check_rollouts():
+    ecs = get_account_client("ecs", account=environment, session_name="TrackDeploymentSession")
+    for tracker, snapshot in describe_trackers(ecs, [tracker for tracker in trackers if not tracker.done()]):
+      tracker.update(ecs, snapshot)
+    check_stopped_tasks(ecs, watcher, [tracker for tracker in trackers if tracker.watching_tasks()])
+    if all(tracker.done() for tracker in trackers):
+      return max(tracker.exit_code for tracker in trackers)
+    return None
+
+  try:
+    return poll(check_rollouts, "service rollout state", timeout=rollout_timeout, initial_interval=5, max_interval=30, phase="poll-rollout")
+  except PollTimeout as error:
+    logging.error(str(error))
+    for tracker in trackers:
+      if (not tracker.done()):
+        tracker.log(logging.ERROR, "Timed out waiting for rollout")
+        tracker.finish(1)
+    return 1
+
+# Writes the timeline of every tracked deployment to a JSON artifact and adds
+# them to the metrics spool, next to the pipeline status of each service.
+def report_timelines(trackers: list, path: str):
+  timelines = [tracker.timeline for tracker in trackers if tracker.timeline is not None]
+  if (len(timelines) == 0):
+    return
+  with open(path, "w") as file:
+    json.dump([timeline.as_dict() for timeline in timelines], file, indent=2)
+  logging.info("Deployment timeline written to: " + path)
+  for timeline in timelines:
+    record_gauges(job=(timeline.service + "_" + timeline.environment), gauges=timeline.gauges())
+
+def check_edge_cases(snapshot: ServiceSnapshot, environment: str, service: str) -> int:
+  deployments = snapshot.ordered_deployments
   if (len(deployments) == 1):
-    if (deployments[0]["rolloutState"] == "COMPLETED"):
+    if (deployments[0].rollout_state == "COMPLETED"):
       if ((environment == "production")):
         logging.error("No deployment to environment: " + environment + " has been found to track for service: " + service)
-        exit(1)
-      elif (deployments[0]["desiredCount"] != 0):
+        return 1
+      elif (deployments[0].desired_count != 0):
         logging.error("No deployment to environment: " + environment + " has been found to track for service: " + service)
-        exit(0)
+        return 0
   if (len(deployments) > 2):
     logging.warning("More than 1 deployment is currently being deployed at once, will track the most recent")
     logging.warning("Try not to run one more pipeline per environment at a time")
+  return None
 
-def parse_deployment_state(deployments: dict, deployment_id: str) -> str:
-  for deployment in deployments:
-    if (deployment["id"] == deployment_id):
-      return deployment["rolloutState"]
+def parse_service_state(events: list, success: str) -> bool:
+  for event in events:
+    if success in event["message"]:
+      return True
+  return False
 
-def parse_failed_tasks(deployments: dict, deployment_id: str) -> int:
-  for deployment in deployments:
-    if (deployment["id"] == deployment_id):
-      return deployment["failedTasks"]
 
-def parse_running_count(deployments: dict, deployment_id: str) -> int:
-  for deployment in deployments:
-    if (deployment["id"] == deployment_id):
-      return deployment["runningCount"]
+def main(argv: list = None):
+  parser = argparse.ArgumentParser(description="AWS ECS Track Deployment Script")
 
-def parse_pending_count(deployments: dict, deployment_id: str) -> int:
-  for deployment in deployments:
-    if (deployment["id"] == deployment_id):
-      return deployment["pendingCount"]
+  parser.add_argument("--service", type=str, nargs='+', required=True, help="The names of the services we are interacting with, optionally as cluster/service")
+  parser.add_argument("--environment", type=str, required=True, help="The name of the environment we are interacting with")
+  parser.add_argument("--cluster", nargs='?', default="core-services", type=str, help="The name of the cluster used for services given without one")
+  parser.add_argument("--timeout", default=2400, type=int, help="The number of seconds to wait for a rollout before giving up")
+  parser.add_argument("--failure-budget", default=3, type=int, help="The number of failed tasks (non zero exit codes, failed health checks or image pulls) before a rollout is reverted, 0 disables the check")
+  parser.add_argument("--timeline", default="deployment_timeline.json", type=str, help="The file the timeline of each tracked deployment is written to")
+  parser.add_argument("--stopped-task-interval", default=30, type=int, help="The minimum number of seconds between checks of a rollout's stopped tasks")
 
-def parse_service_state(events: dict, success: str) -> bool:
-  if success in events[0]["message"]:
-    return True
-  else:
-    return False
+  args = parser.parse_args(argv)
 
+  logging.getLogger().setLevel("INFO")
 
-def main():
-  parser = argparse.ArgumentParser(description="AWS ECS Track Deployment Script")
+  global rollout_timeout, failure_budget, stopped_task_interval
+  rollout_timeout = args.timeout
+  failure_budget = args.failure_budget
+  stopped_task_interval = args.stopped_task_interval
 
-  parser.add_argument("--service", type=str, required=True, help="The name of the service we are interacting with")
-  parser.add_argument("--environment", type=str, required=True, help="The name of the environment we are interacting with")
-  parser.add_argument("--cluster", nargs='?', default="core-services", type=str, help="The name of the environment we are interacting with")
+  targets = parse_service_targets(args.service, default_cluster=args.cluster)
+  trackers = []
+  for cluster, service in targets:
+    prefix = ""
+    if (len(targets) > 1):
+      prefix = "[" + cluster + "/" + service + "] "
+    trackers.append(RolloutTracker(cluster=cluster, service=service, environment=args.environment, prefix=prefix))
 
-  args = parser.parse_args()
+  ecs = get_account_client("ecs", account=args.environment, session_name="TrackDeploymentSession")
+  for tracker, snapshot in describe_trackers(ecs, trackers):
+    tracker.start(ecs, snapshot)
 
-  logging.getLogger().setLevel("INFO")
+  exit_code = 0
+  if (not all(tracker.done() for tracker in trackers)):
+    exit_code = track_rollouts(trackers=trackers, environment=args.environment)
+  exit_code = max([exit_code] + [tracker.exit_code for tracker in trackers])
+  report_timelines(trackers=trackers, path=args.timeline)
 
-  global cluster
-  cluster = args.cluster
-
-  credentials = switch_role(account=args.environment, session_name="TrackDeploymentSession")
-  ecs = get_aws_client("ecs", credentials)
-  services = ecs.describe_services(cluster=cluster, services=[args.service])
-
-  if (len(services["services"]) > 1):
-    logging.error("More than one service was matched, please contact administrator")
-    exit(1)
-  
-  deployments = sort_deployments(services["services"][0]["deployments"])
-  check_edge_cases(deployments=deployments, environment=args.environment, service=args.service)
-
-  healthy_task_definition = None
-  if (deployments[-1]["rolloutState"] == "COMPLETED"):
-    healthy_task_definition = deployments[-1]["taskDefinition"]
-  else:
-    logging.warning("No healthy rollout state to revert to in case of failure")
-
-  if (args.environment != "production"):
-    if (deployments[0]["desiredCount"] == 0):
-      if (deployments[-1]["desiredCount"] == 0):
-        logging.warning("Service is currently scaled down, will try to scale the most recent deployment up")
-        deployments = sort_deployments(ecs.update_service(cluster=cluster, service=args.service, desiredCount=1)["service"]["deployments"])
-
-  deployment_id = deployments[0]["id"]
-
-  if (not track_rollout(deployment_id=deployment_id, environment=args.environment, service=args.service)):
-    if (healthy_task_definition != None):
-      revert_rollout(task_definition=healthy_task_definition, environment=args.environment, service=args.service)
-    else:
-      logging.error("No past healthy deployment to revert to")
-      exit(1)
+  if (len(trackers) > 1):
+    for tracker in trackers:
+      tracker.log(logging.INFO if tracker.exit_code == 0 else logging.ERROR, "Finished with exit status (" + str(tracker.exit_code) + ")")
+  exit(exit_code)
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  main()
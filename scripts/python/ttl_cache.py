@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Entries live in memory for the lifetime of the process and, unless disabled,
+# in a job scoped directory so that later workflow steps can reuse them.
+def default_cache_directory() -> str:
+  if ("DEPLOYMENT_CACHE_DIR" in os.environ):
+    return os.environ["DEPLOYMENT_CACHE_DIR"]
+  job_id = "-".join([
+    os.environ.get("GITHUB_RUN_ID", "local"),
+    os.environ.get("GITHUB_RUN_ATTEMPT", "1"),
+    os.environ.get("GITHUB_JOB", "job"),
+  ])
+  return os.path.join(os.environ.get("RUNNER_TEMP", tempfile.gettempdir()), "deployment-cache", job_id)
+
+# Outlives the job, for entries that stay valid across runs on self hosted
+# runners (such as ECR tokens).
+def persistent_cache_directory() -> str:
+  if ("DEPLOYMENT_PERSISTENT_CACHE_DIR" in os.environ):
+    return os.environ["DEPLOYMENT_PERSISTENT_CACHE_DIR"]
+  return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "deployment-cache")
+
+def disk_cache_enabled() -> bool:
+  return os.environ.get("DEPLOYMENT_CACHE", "on").lower() not in ["off", "false", "0"]
+
+class TTLCache:
+  def __init__(self, namespace: str, directory: str = None, margin: int = 0, persistent: bool = True):
+    self.namespace = namespace
+    self.directory = directory
+    self.margin = margin
+    self.persistent = persistent
+    self._entries = {}
+    self._lock = threading.Lock()
+    self._key_locks = {}
+
+  def get(self, key: str):
+    with self._lock:
+      entry = self._entries.get(key)
+      if ((entry is not None) and (not self._expired(entry))):
+        return entry["value"]
+      self._entries.pop(key, None)
+    entry = self._read(key)
+    if (entry is None):
+      return None
+    with self._lock:
+      self._entries[key] = entry
+    return entry["value"]
+
+  def set(self, key: str, value, expires_at: float):
+    entry = {"key": key, "expires_at": expires_at, "value": value}
+    with self._lock:
+      self._entries[key] = entry
+    self._write(key, entry)
+
+  def get_or_create(self, key: str, creator):
+    value = self.get(key)
+    if (value is not None):
+      return value
+    with self._key_lock(key):
+      value = self.get(key)
+      if (value is None):
+        value, expires_at = creator()
+        self.set(key, value, expires_at)
+      return value
+
+  def evict(self, key: str):
+    with self._lock:
+      self._entries.pop(key, None)
+    path = self._path(key)
+    if ((path is not None) and os.path.isfile(path)):
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+  def _key_lock(self, key: str) -> threading.Lock:
+    with self._lock:
+      if (key not in self._key_locks):
+        self._key_locks[key] = threading.Lock()
+      return self._key_locks[key]
+
+  def _expired(self, entry: dict) -> bool:
+    return (entry["expires_at"] - self.margin) <= time.time()
+
+  def _path(self, key: str):
+    if ((not self.persistent) or (not disk_cache_enabled())):
+      return None
+    directory = os.path.join(self.directory or default_cache_directory(), self.namespace)
+    return os.path.join(directory, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+  def _read(self, key: str):
+    path = self._path(key)
+    if ((path is None) or (not os.path.isfile(path))):
+      return None
+    try:
+      with open(path, "r") as file:
+        entry = json.load(file)
+    except (OSError, ValueError):
+      return None
+    if ((entry.get("key") != key) or self._expired(entry)):
+      self.evict(key)
+      return None
+    return entry
+
+  def _write(self, key: str, entry: dict):
+    path = self._path(key)
+    if (path is None):
+      return
+    try:
+      os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+      descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+      with os.fdopen(descriptor, "w") as file:
+        json.dump(entry, file)
+      os.chmod(temporary_path, 0o600)
+      os.replace(temporary_path, path)
+    except OSError:
+      pass
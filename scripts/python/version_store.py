@@ -0,0 +1,86 @@
+from deployment_utilities import get_account_client
+from ttl_cache import TTLCache
+from packaging import version
+import logging
+import os
+import time
+
+version_prefix = "/ecs/versions/"
+version_cache = TTLCache("versions")
+version_ttl = int(os.environ.get("DEPLOYMENT_VERSION_TTL", 300))
+
+class VersionConflict(Exception):
+  pass
+
+# Service versions kept in SSM parameter store under /ecs/versions/<service>.
+# Reads are batched (10 names per get_parameters call) and cached for the job.
+# Saves are optimistic: put_parameter returns the new parameter version, which
+# is exactly one more than the version that was read unless another pipeline
+# wrote in between. When that happens the versions written in between are read
+# back and the highest one is restored.
+class VersionStore:
+  def __init__(self, ssm=None, prefix: str = version_prefix):
+    self.ssm = ssm or get_account_client("ssm", account="management", session_name="IterateVersionSession")
+    self.prefix = prefix
+
+  def parameter_name(self, service: str) -> str:
+    return self.prefix + service
+
+  def load(self, services: list, refresh: bool = False) -> dict:
+    parameters = {}
+    missing = []
+    for service in services:
+      cached = None if refresh else version_cache.get(service)
+      if (cached is not None):
+        parameters[service] = cached
+      else:
+        missing.append(service)
+    for i in range(0, len(missing), 10):
+      response = self.ssm.get_parameters(Names=[self.parameter_name(service) for service in missing[i:(i + 10)]])
+      for parameter in response["Parameters"]:
+        service = parameter["Name"][len(self.prefix):]
+        parameters[service] = self.remember(service, parameter)
+      for name in response.get("InvalidParameters", []):
+        logging.warning("No version found in parameter store: " + name)
+    return parameters
+
+  def remember(self, service: str, parameter: dict) -> dict:
+    entry = {"value": parameter["Value"], "version": parameter["Version"]}
+    version_cache.set(service, entry, time.time() + version_ttl)
+    return entry
+
+  def get(self, service: str) -> str:
+    parameters = self.load([service])
+    if (service not in parameters):
+      raise KeyError("No version found in parameter store for service: " + service)
+    return parameters[service]["value"]
+
+  # Returns the value left in the store, which is new_version unless a higher
+  # version had already been saved by another pipeline. A stale cached read is
+  # safe here, it only shows up as a conflict.
+  def save(self, service: str, new_version: str, retries: int = 5) -> str:
+    current = self.load([service]).get(service, {"value": "0.0.0", "version": 0})
+    for attempt in range(retries + 1):
+      if (version.parse(new_version) <= version.parse(current["value"])):
+        return current["value"]
+      written = self.ssm.put_parameter(Name=self.parameter_name(service), Value=new_version, Type="String", Overwrite=True)["Version"]
+      self.remember(service, {"Value": new_version, "Version": written})
+      if (written == (current["version"] + 1)):
+        return new_version
+      logging.warning("Version of service: " + service + " was changed by another pipeline while saving, resolving the conflict")
+      concurrent_versions = self.read_versions(service, first=(current["version"] + 1), last=(written - 1))
+      if (len(concurrent_versions) == 0):
+        return new_version
+      # Our write is the latest, so the highest concurrent version has to be
+      # put back on top of it if it beats ours
+      current = {"value": new_version, "version": written}
+      new_version = max(concurrent_versions, key=version.parse)
+    raise VersionConflict("Unable to save the version of service: " + service + " after (" + str(retries) + ") retries")
+
+  def read_versions(self, service: str, first: int, last: int) -> list:
+    values = []
+    selectors = [self.parameter_name(service) + ":" + str(number) for number in range(first, (last + 1))]
+    for i in range(0, len(selectors), 10):
+      response = self.ssm.get_parameters(Names=selectors[i:(i + 10)])
+      values.extend(parameter["Value"] for parameter in response["Parameters"])
+    return values
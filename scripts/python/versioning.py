@@ -1,68 +1,77 @@
-import boto3
 from deployment_utilities import *
-from packaging import version
+from version_store import VersionStore
 import logging
-import os.path
+import os
 import argparse
 import json
 import shutil
 
-def retrieve_service_version(service: str):
-  credentials = switch_role(account="management", session_name="IterateVersionSession")
-  ssm = get_aws_client("ssm", credentials)
-  parameter_path = "/ecs/versions/" + service
-  return ssm.get_parameter(Name=parameter_path)["Parameter"]["Value"]
-
-def fetch(service: str, directory: str):
-  logging.info("Fetching the version in parameter store for service: " + service)
+def fetch(services: list, directory: str):
+  logging.info("Fetching the version in parameter store for services: " + ", ".join(services))
+  versions = VersionStore().load(services)
+  for service in services:
+    if (service not in versions):
+      logging.error("Unable to fetch the version of service: " + service)
+      exit(1)
+  if (len(services) > 1):
+    for service in services:
+      write_package(service=service, remote_version=versions[service]["value"], directory=os.path.join(directory, service, ""))
+    return
+  service = services[0]
   if (os.path.isfile("../package.json")):
     logging.info("package.json already exists in the root directory of this repository, using it instead of creating")
     with open("../package.json", "r+") as file:
       package = json.load(file)
-      package["version"] = retrieve_service_version(service=service)
+      package["version"] = versions[service]["value"]
       file.seek(0)
       json.dump(package, file, indent=2)
+      file.truncate()
     shutil.copy("../package.json", "package.json")
     logging.info("Successfuly updated package.json")
   else:
-    with open((directory + "package.json"), "w") as file:
-      package = {}
-      package["name"] = service
-      package["version"] = retrieve_service_version(service=service)
-      json.dump(package, file, indent=2)
-    logging.info("Successfuly created package.json")
+    write_package(service=service, remote_version=versions[service]["value"], directory=directory)
+
+def write_package(service: str, remote_version: str, directory: str):
+  os.makedirs(directory, exist_ok=True)
+  with open((directory + "package.json"), "w") as file:
+    package = {}
+    package["name"] = service
+    package["version"] = remote_version
+    json.dump(package, file, indent=2)
+  logging.info("Successfuly created " + directory + "package.json")
 
-def save(service: str, directory: str):
-  logging.info("Attempting to save the version in parameter store for service: " + service)
-  with open((directory + "package.json"), "r") as file:
-    local_version = json.load(file)["version"]
-    remote_version = retrieve_service_version(service=service)
-    if (version.parse(local_version) < version.parse(remote_version)):
+def save(services: list, directory: str):
+  logging.info("Attempting to save the version in parameter store for services: " + ", ".join(services))
+  store = VersionStore()
+  previous_versions = store.load(services, refresh=True)
+  for service in services:
+    package_directory = os.path.join(directory, service, "") if (len(services) > 1) else directory
+    with open((package_directory + "package.json"), "r") as file:
+      local_version = json.load(file)["version"]
+    remote_version = previous_versions.get(service, {"value": "0.0.0"})["value"]
+    saved_version = store.save(service=service, new_version=local_version)
+    if (saved_version != local_version):
       logging.warning("Another pipeline is likely running in a higher environment simultaneously, please try not to do this")
-      logging.warning("Skipping version update")
+      logging.warning("Skipping version update of service: " + service + ", parameter store has [" + saved_version + "]")
     else:
-      credentials = switch_role(account="management", session_name="IterateVersionSession")
-      ssm = get_aws_client("ssm", credentials)
-      parameter_path = "/ecs/versions/" + service
-      ssm.put_parameter(Name=parameter_path, Value=local_version, Overwrite=True)
       logging.info("Successfuly updated version of service: " + service + " from [" + remote_version + "] to [" + local_version + "]")
 
-def main():
+def main(argv: list = None):
   parser = argparse.ArgumentParser(description="AWS ECS Service Versioning Script")
 
-  parser.add_argument("--service", type=str, required=True, help="The name of the service we are interacting with")
+  parser.add_argument("--service", type=str, nargs='+', required=True, help="The names of the services we are interacting with, each with its package.json in a subdirectory of --directory named after it when there is more than one")
   parser.add_argument("--fetch", action="store_true", help="Fetches the version of the service from AWS Parameter Store and store it in package.json format")
   parser.add_argument("--save", action="store_true", help="Saves the version of the service in AWS Parameter Store.")
   parser.add_argument("--directory", nargs='?', default="./", type=str, help="The directory to find package.json in.")
 
-  args = parser.parse_args()
+  args = parser.parse_args(argv)
 
   logging.getLogger().setLevel("INFO")
 
   if (args.fetch):
-    fetch(service=args.service, directory=args.directory)
+    fetch(services=args.service, directory=args.directory)
   elif (args.save):
-    save(service=args.service, directory=args.directory)
+    save(services=args.service, directory=args.directory)
   else:
     print("Error: please use one of either --fetch or --save")
 